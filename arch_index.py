@@ -0,0 +1,129 @@
+"""Script:  arch_index.py
+
+Domain architectures of the eligible targets for coverage.py. Domain names
+are interned to integer ids and each architecture is held as a tuple of ids,
+ordered by domain name, together with a bitset of the domains it contains.
+Validity is computed once per architecture against the bitset of validated
+domains, so count_valid and the exporters in coverage.py read flags and
+counts from the index instead of splitting architecture strings.
+
+--------------------
+Author:
+Felix Kruger
+fkrueger@ebi.ac.uk
+"""
+
+
+class ArchIndex(object):
+    """
+    Architectures, their target and activity counts and the number of
+    multi-domain targets per domain.
+    """
+    def __init__(self, valid_doms):
+        """
+        Inputs:
+        valid_doms -- iterable of validated domain names
+        """
+        self.names = []
+        self.ids = {}
+        self.valid_mask = 0
+        for dom in valid_doms:
+            self.valid_mask |= 1 << self.intern(dom)
+        self.archs = {}
+        self.doms = []
+        self.masks = []
+        self.targets = []
+        self.acts = []
+        self.dom_targets = {}
+        self._valid = None
+
+    def intern(self, dom):
+        """Return the integer id of a domain name."""
+        try:
+            return self.ids[dom]
+        except KeyError:
+            dom_id = self.ids[dom] = len(self.names)
+            self.names.append(dom)
+            return dom_id
+
+    def add(self, doms, act_count):
+        """Add a target.
+        Inputs:
+        doms -- list of the domain names of the target, repeated domains included
+        act_count -- number of activities of the target
+        """
+        key = tuple([self.intern(dom) for dom in sorted(doms)])
+        try:
+            idx = self.archs[key]
+        except KeyError:
+            idx = self.archs[key] = len(self.doms)
+            mask = 0
+            for dom_id in key:
+                mask |= 1 << dom_id
+            self.doms.append(key)
+            self.masks.append(mask)
+            self.targets.append(0)
+            self.acts.append(0)
+            self._valid = None
+        self.targets[idx] += 1
+        self.acts[idx] += act_count
+        if len(key) > 1:
+            for dom_id in set(key):
+                self.dom_targets[dom_id] = self.dom_targets.get(dom_id, 0) + 1
+
+    def mask(self, doms):
+        """Bitset of a set of domain names. Names not seen so far are left
+        out, as no architecture can contain them."""
+        mask = 0
+        for dom in doms:
+            dom_id = self.ids.get(dom)
+            if dom_id is not None:
+                mask |= 1 << dom_id
+        return mask
+
+    @property
+    def valid(self):
+        """List of flags, True for architectures containing a validated domain."""
+        if self._valid is None:
+            self._valid = [bool(mask & self.valid_mask) for mask in self.masks]
+        return self._valid
+
+    def is_valid_dom(self, dom_id):
+        return bool(self.valid_mask >> dom_id & 1)
+
+    def label(self, idx):
+        """Architecture string, domain names joined by ', '."""
+        return ', '.join([self.names[dom_id] for dom_id in self.doms[idx]])
+
+    def multi(self):
+        """Indices of the architectures with more than one domain."""
+        return [idx for idx in range(len(self.doms)) if len(self.doms[idx]) > 1]
+
+    def coverage(self, counts, valid_mask=None):
+        """Sum of counts over valid and over all architectures, and the number
+        of valid and of all architectures.
+        Inputs:
+        counts -- self.targets or self.acts
+        valid_mask -- bitset of validated domains, defaults to self.valid_mask
+        """
+        if valid_mask is None:
+            valid = self.valid
+        else:
+            valid = [bool(mask & valid_mask) for mask in self.masks]
+        return (sum([c for (c, v) in zip(counts, valid) if v]), sum(counts),
+                sum(valid), len(counts))
+
+    def pairs(self):
+        """Count co-occurring domains in multi-domain architectures, weighted by
+        the number of targets. Returns a dictionary keyed by (dom_id, dom_id)
+        ordered by domain name; repeated domains pair with themselves.
+        """
+        lkp = {}
+        for idx in self.multi():
+            doms = self.doms[idx]
+            count = self.targets[idx]
+            for i in range(len(doms) - 1):
+                for j in range(i + 1, len(doms)):
+                    key = (doms[i], doms[j])
+                    lkp[key] = lkp.get(key, 0) + count
+        return lkp
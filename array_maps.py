@@ -0,0 +1,182 @@
+"""Script:  array_maps.py
+
+Array-backed alternative to map_ints and flag_conflicts in loader.py. The rows
+returned by loader.get_acts are held in NumPy columns (activity_id, compd_id,
+domain_id) and the flags are computed by sorting and grouping instead of
+building a dictionary per activity. format_rows produces the same lines, in the
+same order, as loader.format_rows. Select it with engine: numpy in local.yaml.
+
+--------------------
+Author:
+Felix Kruger
+fkrueger@ebi.ac.uk
+"""
+from array import array
+import rowwriter
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def collect(acts, columns=None):
+    """ Append the activity_id, compd_id and domain_id of each row to
+    columns of machine integers and record the domain names.
+
+    Inputs:
+    acts -- output of the sql query in get_acts(), any iterable of rows.
+    columns -- columns to append to, as returned by collect; new ones if not given
+
+    Returns the columns: a tuple of three arrays and a dictionary
+    domain_names[domain_id] = domain_name.
+
+    """
+    if columns is None:
+        columns = (array('l'), array('l'), array('l'), {})
+    (act_col, compd_col, dom_col, domain_names) = columns
+    for act in acts:
+        (act_id, tid, component_id, compd_id, domain_name, domain_id) = act
+        act_col.append(act_id)
+        compd_col.append(compd_id)
+        dom_col.append(domain_id)
+        domain_names[domain_id] = domain_name
+    return columns
+
+
+def extend(columns, part):
+    """ Append the columns of part, as returned by collect, to columns. """
+    for (column, values) in zip(columns[:3], part[:3]):
+        column.extend(values)
+    columns[3].update(part[3])
+    return columns
+
+
+def map_ints(acts):
+    """ Map interactions to activity ids.
+
+    Inputs:
+    acts -- output of the sql query in get_acts(), any iterable of rows.
+
+    Returns the dictionary of arrays of map_columns.
+
+    """
+    return map_columns(collect(acts))
+
+
+def map_columns(columns):
+    """ Map interactions to activity ids.
+
+    Inputs:
+    columns -- activity, compd and domain ids of the rows of get_acts(), as returned by collect.
+
+    Returns a dictionary of arrays with one entry per distinct
+    (activity_id, compd_id) pair, sorted by activity_id and compd_id:
+    act_id, compd_id, domain_id -- the pair and its domain (last row wins, as in loader.map_ints)
+    first -- index of the first row in which the pair occurs
+    and a dictionary domain_names[domain_id] = domain_name.
+
+    """
+    if np is None:
+        raise ImportError('engine: numpy requires the numpy package')
+    (act_col, compd_col, dom_col, domain_names) = columns
+    act_ids = np.frombuffer(act_col, dtype=np.int_) if act_col else np.zeros(0, dtype=np.int_)
+    compd_ids = np.frombuffer(compd_col, dtype=np.int_) if compd_col else np.zeros(0, dtype=np.int_)
+    dom_ids = np.frombuffer(dom_col, dtype=np.int_) if dom_col else np.zeros(0, dtype=np.int_)
+    row_idx = np.arange(len(act_ids))
+
+    # Group rows by (activity_id, compd_id), keeping row order within groups.
+    order = np.lexsort((row_idx, compd_ids, act_ids))
+    act_ids = act_ids[order]
+    compd_ids = compd_ids[order]
+    dom_ids = dom_ids[order]
+    row_idx = row_idx[order]
+    starts = np.ones(len(act_ids), dtype=bool)
+    starts[1:] = (act_ids[1:] != act_ids[:-1]) | (compd_ids[1:] != compd_ids[:-1])
+    start_idx = np.flatnonzero(starts)
+    last_idx = np.flatnonzero(np.append(starts[1:], True)[:len(starts)])
+    return {'act_id': act_ids[start_idx],
+            'compd_id': compd_ids[start_idx],
+            'domain_id': dom_ids[last_idx],
+            'first': row_idx[start_idx],
+            'domain_names': domain_names}
+
+
+def flag_conflicts(maps):
+    """Assign a set of flags to each activity: category, status, manual.
+
+    Input:
+    maps -- output of map_ints()
+
+    Returns a dictionary of arrays with one entry per activity, sorted by
+    activity_id: act_id, category_flag, status_flag, manual_flag, and
+    offset -- position of the activity's first pair in maps.
+
+    """
+    act_ids = maps['act_id']
+    starts = np.ones(len(act_ids), dtype=bool)
+    starts[1:] = act_ids[1:] != act_ids[:-1]
+    offset = np.flatnonzero(starts)
+    group = np.cumsum(starts) - 1
+    n_compds = np.diff(np.append(offset, len(act_ids)))
+    # Count distinct domains per activity.
+    pairs = np.unique(np.stack((group, maps['domain_id'])), axis=1) if len(act_ids) else np.zeros((2, 0), dtype=np.int_)
+    n_doms = np.bincount(pairs[0], minlength=len(offset))
+    category = np.where(n_compds == 1, 0, np.where(n_doms > 1, 2, 1)) # one validated domain, multiple validated domains or multiple instances of one val. dom.
+    status = (n_compds > 1).astype(np.int_)
+    return {'act_id': act_ids[offset],
+            'category_flag': category,
+            'status_flag': status,
+            'manual_flag': np.zeros(len(offset), dtype=np.int_),
+            'offset': offset}
+
+
+def format_rows(maps, flags, manuals, params):
+    """ Generate the lines of the automatic mapping table, without header.
+    Activities and compd_ids are visited in the order loader.format_rows
+    visits them, so the output is identical.
+
+    Input:
+    maps -- output of map_ints()
+    flags -- output of flag_conflicts()
+    manuals -- set of the activity_ids of manual mappings
+
+    Lines are formatted from the sorted arrays in batches of
+    params['write_batch'] activities. Only the iteration order of
+    loader.format_rows is taken from Python containers: the set of
+    activity_ids, and the dictionary of compd_ids of activities with more
+    than one compd_id.
+
+    """
+    offset = flags['offset']
+    n_pairs = len(maps['act_id'])
+    n_compds = np.diff(np.append(offset, n_pairs))
+    # Rows of each activity in the key order of loader.map_ints, ie. of
+    # first occurrence, then in dictionary order where there are several.
+    group = np.repeat(np.arange(len(offset)), n_compds)
+    by_first = np.lexsort((maps['first'], group))
+    perm = by_first.tolist()
+    compd_ids = maps['compd_id'][by_first].tolist()
+    for (start, stop) in zip(offset[n_compds > 1].tolist(), (offset + n_compds)[n_compds > 1].tolist()):
+        perm[start:stop] = dict(zip(compd_ids[start:stop], perm[start:stop])).values()
+    perm = np.array(perm, dtype=np.int_)
+    first = np.minimum.reduceat(maps['first'], offset) if len(offset) else maps['first']
+    by_first = np.argsort(first, kind='mergesort')
+    # The activity order of set(map(int, lkp.keys())) - manuals, lkp having been filled in order of first occurrence.
+    act_order = np.array(list(set(map(int, dict.fromkeys(flags['act_id'][by_first].tolist()).keys())) - manuals), dtype=np.int_)
+    template = rowwriter.bind(rowwriter.MAPS_LINE, {6: params['comment'], 7: params['timestamp'], 8: params['submitter']})
+    names = maps['domain_names']
+    batch = params.get('write_batch', 10000)
+    for i in range(0, len(act_order), batch):
+        pos = np.searchsorted(flags['act_id'], act_order[i:i + batch])
+        counts = n_compds[pos]
+        within = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        rows = perm[np.repeat(offset[pos], counts) + within]
+        dom_ids = maps['domain_id'][rows]
+        (uniq, inverse) = np.unique(dom_ids, return_inverse=True)
+        dom_names = np.array([names[x] for x in uniq.tolist()], dtype=object)[inverse]
+        lines = map(template.__mod__, zip(maps['act_id'][rows].tolist(), maps['compd_id'][rows].tolist(), dom_names.tolist(),
+                                          np.repeat(flags['category_flag'][pos], counts).tolist(),
+                                          np.repeat(flags['status_flag'][pos], counts).tolist(),
+                                          np.repeat(flags['manual_flag'][pos], counts).tolist(), dom_ids.tolist()))
+        for line in lines:
+            yield line
@@ -0,0 +1,343 @@
+"""Script:  benchmark.py
+
+Time the stages of the loader pipeline on synthetic data and record their
+peak memory. eg.:
+    $> python benchmark.py run results.json 10k 1M 10M
+    $> python benchmark.py compare results.json baseline.json
+    $> python benchmark.py doms doms.json 10 1k 100k
+
+Synthetic get_acts rows are generated at each scale (number of rows). The
+number of compd_ids per conflicting activity is sampled from the shipped
+data/manual_pfam_maps_v_<version>.tab files, and the shares of conflicting
+and duplicated domains among those activities are measured from them. Part
+of the conflicting activities reuse the manual activity_ids so that
+write_table has manual mappings to exclude. Each stage runs in its own process, so the peak RSS it
+reports is not inflated by the stages before it; on Linux the peak is reset
+once the inputs of the stage are built, so it is not inflated by them either. upload_table runs against
+the SQLite backend (see chembl_stub.py).
+
+The doms command times the domain lookup of coverage.get_doms against the
+database in local.yaml: planning and execution time (from EXPLAIN ANALYZE)
+of the query with the tids inlined as an IN list and passed as an array.
+
+--------------------
+Author:
+Felix Kruger
+fkrueger@ebi.ac.uk
+"""
+import glob
+import json
+import multiprocessing
+import os
+import Queue
+import random
+import shutil
+import sys
+import tempfile
+import time
+import yaml
+import instrument
+import loader
+import tabfile
+import pg2_wrapper
+
+
+STAGES = ('readfile', 'map_ints', 'flag_conflicts', 'write_table', 'append_table', 'add_pk', 'upload_table')
+PARAMS = {'comment': 'synthetic benchmark data', 'timestamp': '06 Aug 2013 14:04:55', 'submitter': 'system'}
+
+
+def parse_scale(scale):
+    """Convert a scale such as 10k or 1M into a number of rows."""
+    factors = {'k': 10 ** 3, 'M': 10 ** 6}
+    if scale[-1] in factors:
+        return int(float(scale[:-1]) * factors[scale[-1]])
+    return int(scale)
+
+
+def conflict_sizes(pattern='data/manual_pfam_maps_v_*.tab'):
+    """Count the compd_ids of each manually mapped activity in the shipped
+    manual files. Returns the list of counts and the set of activity_ids.
+
+    Inputs:
+    pattern -- glob pattern of the manual mapping files
+
+    """
+    sizes = []
+    manual_ids = set()
+    for path in sorted(glob.glob(pattern)):
+        lkp = {}
+        for (act_id,) in tabfile.iter_rows(path, ('activity_id',), {'activity_id': int}):
+            lkp[act_id] = lkp.get(act_id, 0) + 1
+        sizes.extend(lkp.values())
+        manual_ids.update(lkp.keys())
+    return (sizes, sorted(manual_ids))
+
+
+def conflict_ratios(pattern='data/manual_pfam_maps_v_*.tab'):
+    """Measure the shape of the manually mapped activities in the shipped
+    manual files. Returns the share of activities whose compd_ids map to
+    more than one domain (conflicts) and the share of activities in which
+    one domain is mapped by several compd_ids (duplicates).
+
+    Inputs:
+    pattern -- glob pattern of the manual mapping files
+
+    """
+    n_acts = 0
+    n_conflicts = 0
+    n_duplicates = 0
+    for path in sorted(glob.glob(pattern)):
+        lkp = {}
+        for (act_id, domain_name) in tabfile.iter_rows(path, ('activity_id', 'domain_name')):
+            lkp.setdefault(act_id, []).append(domain_name)
+        for doms in lkp.values():
+            n_acts += 1
+            n_conflicts += len(set(doms)) > 1
+            n_duplicates += len(set(doms)) < len(doms)
+    if not n_acts:
+        return (1.0, 0.0)
+    return (n_conflicts / float(n_acts), n_duplicates / float(n_acts))
+
+
+def generate_rows(n_rows, sizes, manual_ids, ratios=(1.0, 0.0), multi_share=0.15, n_domains=250, seed=0):
+    """Generate n_rows synthetic rows in the format of loader.get_acts.
+
+    Inputs:
+    n_rows -- number of rows
+    sizes -- number of compd_ids per conflicting activity to sample from
+    manual_ids -- activity_ids of manual mappings, reused for half of the conflicting activities
+    ratios -- shares of conflicts and duplicates among the activities with several compd_ids, see conflict_ratios
+    multi_share -- share of activities with several compd_ids; the manual files only hold such activities, so this is not measured
+    n_domains -- number of distinct valid domains
+
+    """
+    (conflict_ratio, duplicate_ratio) = ratios
+    rand = random.Random(seed)
+    manual_ids = list(manual_ids)
+    rows = []
+    act_id = max(manual_ids + [0])
+    while len(rows) < n_rows:
+        base = rand.randint(0, 10 ** 6) * n_domains
+        if rand.random() < multi_share:
+            n = max(rand.choice(sizes), 2) if sizes else 2
+            if rand.random() < conflict_ratio:
+                # Several compd_ids on different domains (category 2).
+                compds = [base + i for i in range(n)]
+                if n > 2 and rand.random() < duplicate_ratio:
+                    # One of the domains mapped by two compd_ids.
+                    compds[-1] = base + n_domains
+            else:
+                # Several compd_ids on one domain (category 1).
+                compds = [base + i * n_domains for i in range(n)]
+            if manual_ids and rand.random() < 0.5:
+                this_id = manual_ids.pop()
+            else:
+                act_id += 1
+                this_id = act_id
+        else:
+            compds = [base + rand.randint(0, n_domains - 1)]
+            act_id += 1
+            this_id = act_id
+        tid = compds[0] % 5000
+        for compd_id in compds:
+            domain_id = compd_id % n_domains + 1
+            rows.append((this_id, tid, compd_id // n_domains, compd_id, 'dom_%i' % domain_id, domain_id))
+    return rows[:n_rows]
+
+
+def prepare(stage, workdir, rows, manual_path):
+    """Build the inputs of stage. Returns the function to time and its
+    arguments.
+
+    Inputs:
+    stage -- one of STAGES
+    workdir -- directory holding the intermediate files
+    rows -- output of generate_rows
+    manual_path -- filepath of the manual mappings
+
+    """
+    automatic = os.path.join(workdir, 'automatic.tab')
+    merged = os.path.join(workdir, 'merged.tab')
+    if stage == 'readfile':
+        return (tabfile.read_keys, (automatic, 'activity_id'))
+    if stage == 'append_table':
+        return (loader.append_table, ([manual_path, automatic], os.path.join(workdir, 'append_table.tab')))
+    if stage in ('add_pk', 'upload_table'):
+        path = os.path.join(workdir, '%s.tab' % stage)
+        shutil.copy(merged, path)
+        if stage == 'add_pk':
+            return (loader.add_pk, (path, 'map_id'))
+        loader.add_pk(path, 'map_id')
+        params = dict(PARAMS, backend='sqlite', sqlite_path=os.path.join(workdir, 'bench.db'))
+        return (loader.upload_table, ('pfam_maps', path, loader.CREATE_CALLS['pfam_maps'], params))
+    if stage == 'map_ints':
+        return (loader.map_ints, (rows,))
+    lkp = loader.map_ints(rows)
+    if stage == 'flag_conflicts':
+        return (loader.flag_conflicts, (lkp,))
+    manuals = tabfile.read_keys(manual_path, 'activity_id')
+    return (loader.write_table, (lkp, loader.flag_conflicts(lkp), manuals, PARAMS, os.path.join(workdir, 'write_table.tab')))
+
+
+def run_stage(stage, workdir, rows, manual_path, queue):
+    """Prepare and time one stage, put (seconds, peak_mb) on queue."""
+    (func, args) = prepare(stage, workdir, rows, manual_path)
+    before = instrument.rss_kb()
+    instrument.reset_peak()
+    start = time.time()
+    func(*args)
+    seconds = time.time() - start
+    peak = instrument.peak_rss_kb()
+    queue.put((seconds, max(peak - before, 0) / 1024.0))
+
+
+def wait_stage(proc, queue, poll=1.0):
+    """Wait for the result of a run_stage process. Returns (seconds, peak_mb),
+    or None if the process exited without a result."""
+    while True:
+        try:
+            return queue.get(timeout=poll)
+        except Queue.Empty:
+            if not proc.is_alive():
+                break
+    # The result may have arrived just before the process exited.
+    try:
+        return queue.get(timeout=poll)
+    except Queue.Empty:
+        return None
+
+
+def run(scales, manual_path):
+    """Run all stages at each scale. Returns a dictionary
+    results[scale][stage] = {'seconds': ..., 'peak_mb': ..., 'rows': ...}.
+
+    Inputs:
+    scales -- list of scales such as ['10k', '1M']
+    manual_path -- filepath of the manual mappings
+
+    """
+    (sizes, manual_ids) = conflict_sizes()
+    ratios = conflict_ratios()
+    print "conflicts: %.3f, duplicates: %.3f of the manual activities" % ratios
+    results = {}
+    for scale in scales:
+        workdir = tempfile.mkdtemp(prefix='pfam_bench_')
+        try:
+            rows = generate_rows(parse_scale(scale), sizes, manual_ids, ratios)
+            # Intermediate files for the file stages.
+            lkp = loader.map_ints(rows)
+            manuals = tabfile.read_keys(manual_path, 'activity_id')
+            loader.write_table(lkp, loader.flag_conflicts(lkp), manuals, PARAMS, os.path.join(workdir, 'automatic.tab'))
+            del lkp
+            loader.append_table([manual_path, os.path.join(workdir, 'automatic.tab')], os.path.join(workdir, 'merged.tab'))
+            results[scale] = {}
+            for stage in STAGES:
+                queue = multiprocessing.Queue()
+                proc = multiprocessing.Process(target=run_stage, args=(stage, workdir, rows, manual_path, queue))
+                proc.start()
+                result = wait_stage(proc, queue)
+                proc.join()
+                if result is None or proc.exitcode:
+                    raise RuntimeError('stage %s at %s failed with exit code %s' % (stage, scale, proc.exitcode))
+                (seconds, peak_mb) = result
+                results[scale][stage] = {'seconds': round(seconds, 4), 'peak_mb': round(peak_mb, 1), 'rows': len(rows)}
+                print "%s\t%s\t%.3f s\t%.1f MB" % (scale, stage, seconds, peak_mb)
+        finally:
+            shutil.rmtree(workdir)
+    return results
+
+
+def time_query(query, param, params):
+    """Time one query. On PostgreSQL planning and execution time are read
+    from EXPLAIN ANALYZE; SQLite only reports the wall time of the query.
+    Returns (planning_ms, execution_ms).
+    """
+    if pg2_wrapper.is_sqlite(params):
+        start = time.time()
+        pg2_wrapper.sql_query(query, param, params)
+        return (None, (time.time() - start) * 1000)
+    plan = pg2_wrapper.sql_query('EXPLAIN (ANALYZE, FORMAT JSON) ' + query, param, params)[0][0][0]
+    return (plan['Planning Time'], plan['Execution Time'])
+
+
+def doms(sizes, params):
+    """Time the domain lookup of coverage.get_doms against the number of
+    tids, once with the tids inlined as an IN list and once passed as an
+    array parameter. Returns a dictionary results[n_tids][form] = {'planning_ms': ..., 'execution_ms': ...}.
+
+    Inputs:
+    sizes -- list of numbers of tids
+    params -- dictionary holding details of the connection string
+
+    """
+    import coverage # reads local.yaml on import
+    tids = [x[0] for x in pg2_wrapper.sql_query('SELECT tid FROM target_dictionary ORDER BY tid', None, params)]
+    inline = coverage.DOMS_QUERY.replace('= ANY(%(tids)s)', "IN('%s')")
+    results = {}
+    for n in sizes:
+        # Pad with tids that do not exist when the release has fewer targets.
+        sample = (tids + [-i for i in range(1, n + 1)])[:n]
+        results[n] = {}
+        tidstr = "', '".join(str(t) for t in sample)
+        for (form, query, param) in (('inline', inline % tidstr, None),
+                                     ('array', coverage.DOMS_QUERY, {'tids': sample})):
+            (planning, execution) = time_query(query, param, params)
+            results[n][form] = {'planning_ms': planning, 'execution_ms': round(execution, 3)}
+            print "%i\t%s\t%s ms planning\t%.3f ms execution" % (n, form, planning, execution)
+    return results
+
+
+def compare(results, baseline, tolerance=1.2):
+    """Compare results against a baseline. Prints one line per stage and
+    returns the list of (scale, stage, metric) that regressed by more than
+    tolerance.
+
+    Inputs:
+    results -- output of run
+    baseline -- output of an earlier run
+
+    """
+    regressions = []
+    for scale in sorted(results.keys()):
+        for stage in STAGES:
+            try:
+                new = results[scale][stage]
+                old = baseline[scale][stage]
+            except KeyError:
+                continue
+            for metric in ('seconds', 'peak_mb'):
+                ratio = new[metric] / old[metric] if old[metric] else 1.0
+                if ratio > tolerance:
+                    regressions.append((scale, stage, metric))
+                print "%s\t%s\t%s\t%s -> %s\t(x%.2f)" % (scale, stage, metric, old[metric], new[metric], ratio)
+    return regressions
+
+
+if __name__ == '__main__':
+    if len(sys.argv) >= 3 and sys.argv[1] == 'run':
+        scales = sys.argv[3:] or ['10k', '1M', '10M']
+        manual_path = sorted(glob.glob('data/manual_pfam_maps_v_*.tab'))[-1]
+        results = run(scales, manual_path)
+        with open(sys.argv[2], 'w') as out:
+            json.dump(results, out, indent=2, sort_keys=True)
+    elif len(sys.argv) >= 3 and sys.argv[1] == 'doms':
+        sizes = [parse_scale(x) for x in sys.argv[3:]] or [10, 100, 1000, 10000, 100000]
+        param_file = open('local.yaml')
+        params = yaml.safe_load(param_file)
+        param_file.close()
+        results = doms(sizes, params)
+        pg2_wrapper.close_pools()
+        with open(sys.argv[2], 'w') as out:
+            json.dump(results, out, indent=2, sort_keys=True)
+    elif len(sys.argv) == 4 and sys.argv[1] == 'compare':
+        with open(sys.argv[2]) as infile:
+            results = json.load(infile)
+        with open(sys.argv[3]) as infile:
+            baseline = json.load(infile)
+        regressions = compare(results, baseline)
+        if regressions:
+            sys.exit("regressions: %s" % ', '.join(['/'.join(x) for x in regressions]))
+    else:
+        sys.exit("""Usage: python benchmark.py run <results.json> [scale ...]
+       python benchmark.py compare <results.json> <baseline.json>
+       python benchmark.py doms <results.json> [n_tids ...]""")
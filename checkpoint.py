@@ -0,0 +1,122 @@
+"""Script:  checkpoint.py
+
+Stage checkpoints for loader.loader. After a stage completes, the hash of
+its inputs and the hashes of the files it wrote are recorded in
+<checkpoint_dir>/loader_<release>_<version>.json. The upload stages load
+tables shared by all versions of a release and are recorded in
+<checkpoint_dir>/loader_<release>_uploads.json instead, so that loading
+another version invalidates them. On a rerun a stage whose
+inputs hash to the same value, and whose outputs are still in place and
+unchanged, is skipped; the first stage with changed inputs or without a
+record runs again, and so do the stages after it whose inputs it changed.
+Inputs are the contents of the files a stage reads and the parameters it
+depends on; a release is assumed not to change under its name.
+
+The activities fetched from the release are not checkpointed: when the
+write stage runs again it fetches them again, from query_cache if cache_dir
+is set as well and from the database otherwise.
+
+Checkpoints are enabled by setting checkpoint_dir in local.yaml. Delete the
+files to force a full run.
+
+--------------------
+Author:
+Felix Kruger
+fkrueger@ebi.ac.uk
+"""
+import hashlib
+import json
+import os
+import tabfile
+
+
+def hash_file(path, size=1 << 20):
+    """SHA-1 of the content of a file."""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as infile:
+        for chunk in iter(lambda: infile.read(size), ''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Checkpoints(object):
+    """
+    Records of the completed stages of one release and version, and of the
+    tables uploaded to the release.
+    """
+    def __init__(self, params):
+        self.path = None
+        self.state = {}
+        self.uploads_path = None
+        self.uploads = {}
+        if params.get('checkpoint_dir'):
+            self.path = os.path.join(params['checkpoint_dir'], 'loader_%s_%s.json' % (params['release'], params['version']))
+            self.uploads_path = os.path.join(params['checkpoint_dir'], 'loader_%s_uploads.json' % params['release'])
+            self.state = load(self.path)
+            self.uploads = load(self.uploads_path)
+
+    def records(self, stage):
+        """The path and the records of the file holding stage."""
+        if stage.startswith('upload_'):
+            return (self.uploads_path, self.uploads)
+        return (self.path, self.state)
+
+    def key(self, params, param_names, paths):
+        """Hash the named parameters and the contents of the files at paths,
+        read through tabfile.open_tab. Returns None if checkpoints are off."""
+        if self.path is None:
+            return None
+        digest = hashlib.sha1()
+        digest.update(repr([(name, params.get(name)) for name in sorted(param_names)]))
+        for path in paths:
+            digest.update(path)
+            infile = tabfile.open_tab(path)
+            for line in infile:
+                digest.update(line)
+            if hasattr(infile, 'close'):
+                infile.close()
+        return digest.hexdigest()
+
+    def done(self, stage, key):
+        """Check whether stage completed with inputs hashing to key and left
+        its outputs unchanged."""
+        record = self.records(stage)[1].get(stage)
+        if self.path is None or record is None or record['key'] != key:
+            return False
+        for (path, digest) in record['outputs'].items():
+            if not os.path.exists(path) or hash_file(path) != digest:
+                return False
+        return True
+
+    def mark(self, stage, key, outputs=()):
+        """Record stage as completed with inputs hashing to key and the
+        files it wrote."""
+        if self.path is None:
+            return
+        (path, state) = self.records(stage)
+        state[stage] = {'key': key, 'outputs': dict([(x, hash_file(x)) for x in outputs])}
+        save(path, state)
+
+    def clear(self, stage):
+        """Drop the record of stage, eg. when the table it loaded is replaced."""
+        (path, state) = self.records(stage)
+        if state.pop(stage, None) is not None and path is not None:
+            save(path, state)
+
+
+def load(path):
+    """Records of a checkpoint file, none if it does not exist."""
+    if not os.path.exists(path):
+        return {}
+    with open(path) as infile:
+        return json.load(infile)
+
+
+def save(path, state):
+    """Write the records through a temporary file renamed over the old one."""
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path + '.tmp', 'w') as out:
+        json.dump(state, out, indent=2, sort_keys=True)
+    os.rename(path + '.tmp', path)
@@ -0,0 +1,186 @@
+"""Script:  chembl_stub.py
+
+Build a SQLite stand-in for the subset of the ChEMBL schema that loader.py,
+exporter.py and coverage.py query, filled with synthetic data. Point
+local.yaml at it with backend: sqlite and sqlite_path: <path> to run the
+pipeline without a PostgreSQL release. eg.: $> python chembl_stub.py chembl_stub.db 1000 100000
+
+The valid domains of data/valid_pfam_v_<version>.tab are included so that
+get_acts finds mappings; further Pfam-A domains are generated at random.
+
+--------------------
+Author:
+Felix Kruger
+fkrueger@ebi.ac.uk
+"""
+import math
+import os
+import random
+import sqlite3
+import sys
+import yaml
+import tabfile
+
+
+SCHEMA = """
+CREATE TABLE domains (
+    domain_id INTEGER PRIMARY KEY,
+    domain_type VARCHAR(20) NOT NULL,
+    domain_name VARCHAR(20) NOT NULL
+);
+CREATE TABLE component_sequences (
+    component_id INTEGER PRIMARY KEY,
+    component_type VARCHAR(50),
+    accession VARCHAR(25)
+);
+CREATE TABLE component_domains (
+    compd_id INTEGER PRIMARY KEY,
+    domain_id INTEGER,
+    component_id INTEGER NOT NULL,
+    start_position INTEGER,
+    end_position INTEGER
+);
+CREATE TABLE target_dictionary (
+    tid INTEGER PRIMARY KEY,
+    target_type VARCHAR(30),
+    pref_name VARCHAR(200) NOT NULL
+);
+CREATE TABLE target_components (
+    tid INTEGER NOT NULL,
+    component_id INTEGER NOT NULL,
+    targcomp_id INTEGER PRIMARY KEY
+);
+CREATE TABLE assays (
+    assay_id INTEGER PRIMARY KEY,
+    assay_type VARCHAR(1),
+    tid INTEGER,
+    relationship_type VARCHAR(1)
+);
+CREATE TABLE activities (
+    activity_id INTEGER PRIMARY KEY,
+    assay_id INTEGER NOT NULL,
+    standard_relation VARCHAR(50),
+    standard_value NUMERIC,
+    standard_units VARCHAR(100),
+    standard_type VARCHAR(250),
+    pchembl_value NUMERIC(4, 2)
+);
+CREATE INDEX activities_assay_id ON activities (assay_id);
+CREATE INDEX assays_tid ON assays (tid);
+CREATE INDEX target_components_tid ON target_components (tid);
+CREATE INDEX component_domains_component_id ON component_domains (component_id);
+CREATE INDEX component_domains_domain_id ON component_domains (domain_id);
+"""
+
+
+def read_domains(path):
+    """Read domain_id and domain_name of the valid domains. Domains listed
+    with several lines of evidence are returned once.
+
+    Inputs:
+    path -- filepath of a valid_pfam_v_x_x.tab file
+
+    """
+    lkp = tabfile.read_index(path, 'domain_id', 'domain_name', {'domain_id': int})
+    return sorted(lkp.items())
+
+
+def insert(conn, table, rows):
+    """Insert a list of tuples into table."""
+    if rows:
+        conn.executemany('INSERT INTO %s VALUES (%s)' % (table, ', '.join(['?'] * len(rows[0]))), rows)
+
+
+def build(path, n_targets, n_acts, valid_doms, seed=0):
+    """Create a SQLite database at path holding n_targets targets and
+    n_acts activities.
+
+    Inputs:
+    path -- filepath of the database, replaced if it exists
+    n_targets -- number of targets
+    n_acts -- number of activities
+    valid_doms -- list of (domain_id, domain_name) tuples
+    seed -- seed of the random number generator
+
+    """
+    rand = random.Random(seed)
+    if os.path.exists(path):
+        os.remove(path)
+    conn = sqlite3.connect(path)
+    conn.executescript(SCHEMA)
+
+    # Domains: the valid ones plus as many others.
+    top = max([x[0] for x in valid_doms] + [0])
+    other_doms = [(top + i + 1, 'Pfam_stub_%i' % i) for i in range(len(valid_doms) or 100)]
+    insert(conn, 'domains', [(d, 'Pfam-A', n) for (d, n) in valid_doms + other_doms])
+    dom_ids = [x[0] for x in valid_doms] or [x[0] for x in other_doms]
+    other_ids = [x[0] for x in other_doms]
+
+    # Targets, their components and the domains on each component.
+    targets = []
+    tcs = []
+    comps = []
+    compds = []
+    for tid in range(1, n_targets + 1):
+        r = rand.random()
+        if r < 0.8:
+            target_type = 'SINGLE PROTEIN'
+            n_comps = 1
+        elif r < 0.9:
+            target_type = 'PROTEIN COMPLEX'
+            n_comps = rand.randint(2, 3)
+        else:
+            target_type = 'PROTEIN FAMILY'
+            n_comps = rand.randint(2, 4)
+        targets.append((tid, target_type, 'stub target %i' % tid))
+        for j in range(n_comps):
+            component_id = len(comps) + 1
+            comps.append((component_id, 'PROTEIN', 'P%05i' % component_id))
+            tcs.append((tid, component_id, len(tcs) + 1))
+            # Most components carry one domain, some carry several.
+            n_doms = rand.choice((1, 1, 1, 1, 2, 2, 3))
+            for k in range(n_doms):
+                if rand.random() < 0.6:
+                    domain_id = rand.choice(dom_ids)
+                else:
+                    domain_id = rand.choice(other_ids)
+                compds.append((len(compds) + 1, domain_id, component_id, 100 * k + 1, 100 * k + 90))
+    insert(conn, 'target_dictionary', targets)
+    insert(conn, 'component_sequences', comps)
+    insert(conn, 'target_components', tcs)
+    insert(conn, 'component_domains', compds)
+
+    # Assays, a few per target.
+    assays = []
+    for tid in range(1, n_targets + 1):
+        for j in range(rand.randint(1, 5)):
+            assays.append((len(assays) + 1, rand.choice('BBBFFA'), tid, rand.choice('DDDDHM')))
+    insert(conn, 'assays', assays)
+
+    # Activities, in batches.
+    types = ('Ki', 'Kd', 'IC50', 'EC50', 'AC50', 'Inhibition')
+    batch = []
+    for activity_id in range(1, n_acts + 1):
+        standard_value = round(10 ** rand.uniform(-1, 6), 2)
+        pchembl_value = None
+        if rand.random() < 0.7:
+            pchembl_value = round(9 - math.log10(standard_value), 2)
+        batch.append((activity_id, rand.randint(1, len(assays)), rand.choice('====<>'),
+                      standard_value, 'nM', rand.choice(types), pchembl_value))
+        if len(batch) >= 10000:
+            insert(conn, 'activities', batch)
+            batch = []
+    insert(conn, 'activities', batch)
+    conn.commit()
+    conn.execute('ANALYZE')
+    conn.close()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 4:
+        sys.exit("Usage: python chembl_stub.py <path> <n_targets> <n_activities>, version is read from local.yaml")
+    param_file = open('local.yaml')
+    params = yaml.safe_load(param_file)
+    param_file.close()
+    valid_doms = read_domains('data/valid_pfam_v_%(version)s.tab' % params)
+    build(sys.argv[1], int(sys.argv[2]), int(sys.argv[3]), valid_doms)
@@ -9,8 +9,13 @@
 ####
 #### import modules.
 ####
-import queryDevice
-import operator
+import pg2_wrapper
+import arch_index
+import domain_graph
+import instrument
+import query_cache
+import tabfile
+import target_summary
 import yaml
 import time
 ####
@@ -29,9 +34,14 @@ paramFile.close()
 
 def get_el_targets(params):
     """Query the ChEMBL database for (almost) all activities that are subject to the mapping. Does not conver activities expressed in log-conversion eg pIC50 etc. This function works with chembl_15 upwards. Outputs a list of tuples [(tid, target_type, domain_count, assay_count, act_count),...]
+    With target_summary set, the counts are read from the summary table, see target_summary.py.
     """
-    data = queryDevice.queryDevice("""
-            SELECT DISTINCT dc.tid, dc.target_type, dc.dc, COUNT(DISTINCT act.assay_id), COUNT(DISTINCT activity_id)
+    if params.get('target_summary'):
+        data = target_summary.get_el_targets(target_summary.to_limit(int(params['threshold'])), params)
+        print "retrieved data for ", len(data), "tids from", target_summary.TABLE
+        return data
+    data = query_cache.sql_query("""
+            SELECT dc.tid, dc.target_type, dc.dc, COUNT(DISTINCT act.assay_id), COUNT(DISTINCT activity_id)
             FROM assays ass
             JOIN(
                       SELECT td.tid, td.target_type, COUNT(cd.domain_id) as dc
@@ -54,111 +64,117 @@ def get_el_targets(params):
             AND act.standard_relation IN('=')
             AND standard_units = 'nM'
             AND standard_value <= %s
-            GROUP BY dc.tid ORDER BY COUNT(activity_id)""" % (int(params['threshold']) * 1000) , params)
+            GROUP BY dc.tid, dc.target_type, dc.dc ORDER BY COUNT(activity_id)""" % (int(params['threshold']) * 1000) , [], params)
     print "retrieved data for ", len(data), "tids."
     return data
 
 #-----------------------------------------------------------------------------------------------------------------------
 
 
-def readfile(path, key_name, val_name):
-    """Read two columns from a tab-separated file into a dictionary.
+def get_el_target_buckets(thresholds, params):
+    """Query the ChEMBL database for the activity counts of (almost) all
+    eligible targets, bucketed by standard_value: bucket i holds the
+    activities with thresholds[i-1] < standard_value <= thresholds[i] (in uM).
+    Outputs a list of tuples [(tid, target_type, domain_count, bucket, act_count),...]
     Inputs:
-    path -- filepath
-    key_name -- name of the column holding the key
-    val_name -- name of the column holding the value
+    thresholds -- ascending list of thresholds in uM
     """
-    infile = open(path, 'r')
-    lines = infile.readlines()
-    infile.close()
-    lkp = {}
-    els = lines[0].rstrip().split('\t')
-    for i, el in enumerate(els):
-        if el == key_name:
-            key_idx = i
-        if el == val_name:
-            val_idx = i
-    for line in lines[1:]:
-        elements = line.rstrip().split('\t')
-        lkp[elements[key_idx]] = elements[val_idx]
-    return  lkp
+    if params.get('target_summary'):
+        data = target_summary.get_el_target_buckets([target_summary.to_limit(x) for x in thresholds], params)
+        print "retrieved data for ", len(data), "tid buckets from", target_summary.TABLE
+        return data
+    limits = [x * 1000 for x in thresholds]
+    case = ' '.join(['WHEN standard_value <= %%s THEN %i' % i for i in range(len(limits))])
+    data = query_cache.sql_query("""
+            SELECT dc.tid, dc.target_type, dc.dc, CASE %s END AS bucket, COUNT(DISTINCT activity_id)
+            FROM assays ass
+            JOIN(
+                      SELECT td.tid, td.target_type, COUNT(cd.domain_id) as dc
+                      FROM target_dictionary td
+                      JOIN target_components tc
+                        ON tc.tid = td.tid
+		      JOIN component_sequences cs
+			ON cs.component_id = tc.component_id
+                      JOIN component_domains cd
+ 			ON cd.component_id = cs.component_id
+                      WHERE td.target_type IN('SINGLE PROTEIN', 'PROTEIN COMPLEX')
+                      GROUP BY td.tid
+                     ) as dc
+              ON dc.tid = ass.tid
+            JOIN activities act
+              ON act.assay_id = ass.assay_id
+            WHERE act.standard_type IN('Ki','Kd','IC50','EC50', 'AC50')
+            AND ass.relationship_type = 'D'
+            AND assay_type IN('B')
+            AND act.standard_relation IN('=')
+            AND standard_units = 'nM'
+            AND standard_value <= %%s
+            GROUP BY dc.tid, dc.target_type, dc.dc, bucket""" % case, limits + [limits[-1]], params)
+    print "retrieved data for ", len(data), "tid buckets."
+    return data
 
 #-----------------------------------------------------------------------------------------------------------------------
 
-def get_archs(el_targets, pfam_lkp):
+
+def get_archs(el_targets, pfam_lkp, valid_doms):
     """Find multi-domain architectures.
     Inputs:
     el_targets -- list of eligible targets
+    pfam_lkp -- dictionary of domain names per tid
+    valid_doms -- validated domain names
     """
-    act_lkp = {}
-    arch_lkp = {}
-    dom_lkp = {}
+    index = arch_index.ArchIndex(valid_doms)
     for ent in el_targets:
         try:
             doms = pfam_lkp[ent[0]]
         except KeyError:
             print "no doms in ", ent[0]
-        arch = ', '.join(sorted(doms))
-        try:
-            arch_lkp[arch] += 1
-            act_lkp[arch] += ent[4]
-        except KeyError:
-            arch_lkp[arch] = 1
-            act_lkp[arch] = ent[4]
-        if len(doms) <= 1:
             continue
-        for dom in set(doms):
-            try:
-                dom_lkp[dom] += 1
-            except KeyError:
-                dom_lkp[dom] = 1
-    return(arch_lkp, dom_lkp, act_lkp)
+        index.add(doms, ent[4])
+    return index
 
 #-----------------------------------------------------------------------------------------------------------------------
 
-def get_doms(tids, params):
-    """Get domains for a list of tids.
-    Inputs:
-    el_targets -- list of eligible targets
-    """
-    pfam_lkp = {}
-    tidstr = "', '".join(str(t) for t in tids)
-    data = queryDevice.queryDevice("""
+DOMS_QUERY = """
             SELECT tid, domain_name
             FROM target_components tc
 	    JOIN component_domains cd
 	      ON cd.component_id = tc.component_id
             JOIN domains d
 	      ON d.domain_id = cd.domain_id
-            WHERE tc.tid IN('%s') and domain_type = 'Pfam-A'""" %tidstr, params)
-    for ent in data:
-        tid = ent[0]
-        dom = ent[1]
-        try:
-            pfam_lkp[tid].append(dom)
-        except KeyError:
-            pfam_lkp[tid] = [dom]
+            WHERE tc.tid = ANY(%(tids)s) and domain_type = 'Pfam-A'"""
+
+def get_doms(tids, params):
+    """Get domains for a list of tids. The tids are passed as an array
+    parameter, in chunks of params['key_chunk'], so the query text does not
+    grow with the number of targets.
+    Inputs:
+    el_targets -- list of eligible targets
+    """
+    pfam_lkp = {}
+    tids = [int(t) for t in tids]
+    chunk = params.get('key_chunk', 10000)
+    for i in range(0, len(tids), chunk):
+        data = query_cache.sql_query(DOMS_QUERY, {'tids': tids[i:i + chunk]}, params)
+        for ent in data:
+            tid = ent[0]
+            dom = ent[1]
+            try:
+                pfam_lkp[tid].append(dom)
+            except KeyError:
+                pfam_lkp[tid] = [dom]
     return pfam_lkp
 
 #-----------------------------------------------------------------------------------------------------------------------
 
 
-def count_valid(lkp, valid_doms):
+def count_valid(index, counts):
     """Get count of architectures and activities covered by the mapping.
+    Inputs:
+    index -- ArchIndex of the eligible targets
+    counts -- index.targets or index.acts
     """
-    valz = []
-    for arch in lkp.keys():
-        valid = False
-        doms = arch.split(', ')
-        for dom in doms:
-            if dom in valid_doms:
-                valid = True
-                break
-        valz.append((lkp[arch], valid))
-    valid = sum([x[0] for x in valz if x[1]])
-    allz = sum([x[0] for x in valz])
-    valid_archs = len([x[0] for x in valz if x[1]])
-    all_archs = len(sum([x[0] for x in valz]))
+    (valid, allz, valid_archs, all_archs) = index.coverage(counts)
     out = open('data/log.tab', 'a')
     timestamp = time.strftime('%d %B %Y %T', time.gmtime())
     comment = "only binding assays"
@@ -171,97 +187,131 @@ def count_valid(lkp, valid_doms):
 #-----------------------------------------------------------------------------------------------------------------------
 
 
-def export_archs(arch_lkp, valid_doms, path):
+def export_archs(index, path):
     '''Write out multi-domain architectures in markdown tables.
     Inputs:
-    arch_lkp -- dictionary of multi-domain architectures.
+    index -- ArchIndex of the eligible targets
     '''
-    sorted_archs = sorted(arch_lkp.iteritems(), key=operator.itemgetter(1), reverse = True)
+    labels = dict([(idx, index.label(idx)) for idx in index.multi()])
+    sorted_archs = sorted(labels.keys(), key=lambda idx: (-index.targets[idx], labels[idx]))
     out = open('%s.md' % path ,'w')
     out.write('|architecture|count|mapped|\n')
     out.write('|:-----------|:---------|-----:|\n')
-    for arch in sorted_archs:
-        doms = str(arch[0]).split(', ')
-        if len(doms) <= 1:
-            continue
-        mapped = ', '.join([x for x in doms if x in valid_doms])
-        if len(mapped) == 0:
-            mapped = False
-        out.write("|%s|%s|%s|\n"%(arch[0], arch[1], mapped))
+    for idx in sorted_archs:
+        mapped = False
+        if index.valid[idx]:
+            mapped = ', '.join([index.names[x] for x in index.doms[idx] if index.is_valid_dom(x)])
+        out.write("|%s|%s|%s|\n"%(labels[idx], index.targets[idx], mapped))
+    out.close()
 
 #-----------------------------------------------------------------------------------------------------------------------
 
 
-def export_network(arch_lkp, valid_doms, path):
+def export_network(index, path):
     '''Write out network file.
     Inputs:
-    arch_lkp -- dictionary of multi-domain architectures.
+    index -- ArchIndex of the eligible targets
     '''
-    lkp = {}
-    for arch in arch_lkp.keys():
-        doms = arch.split(', ')
-        if len(doms) <= 1:
-            continue
-        count = arch_lkp[arch]
-        if type(doms) is str:
-            continue
-        for i in range(len(doms)-1):
-            for j in range(i+1, len(doms)):
-                dom_key = ', '.join(sorted([doms[i],doms[j]]))
-                try:
-                   lkp[dom_key] += count
-                except KeyError:
-                   lkp[dom_key] = count
+    lkp = index.pairs()
+    names = index.names
     out = open('%s.tab' % path ,'w')
     out.write('dom_1\tdom_2\tcount\n')
-    for link in lkp.keys():
-        doms = str(link).split(', ')
-        out.write("%s\t%s\t%s\n"%(doms[0], doms[1], lkp[link]))
+    for link in sorted(lkp.keys(), key=lambda x: (names[x[0]], names[x[1]])):
+        out.write("%s\t%s\t%s\n"%(names[link[0]], names[link[1]], lkp[link]))
     out.close()
 
 #-----------------------------------------------------------------------------------------------------------------------
 
 
-def export_attribs(arch_lkp, valid_doms, path):
+def export_attribs(index, path):
     '''Write out network file.
     Inputs:
-    arch_lkp -- dictionary of multi-domain architectures.
+    index -- ArchIndex of the eligible targets
     '''
     out = open('%s.tab' % path ,'w')
     out.write('dom\tvalid\n')
-    lkp = {}
-    for arch in arch_lkp.keys():
-        doms = arch.split(', ')
-        if len(doms) <= 1:
-            continue
-        for dom in doms:
-            valid = False
-            if dom in valid_doms:
-                valid = True
-            lkp[dom] = valid
-    for it in lkp.items():
-        out.write("%s\t%s\n"%(it[0], it[1]))
+    dom_ids = set()
+    for idx in index.multi():
+        dom_ids.update(index.doms[idx])
+    for dom_id in sorted(dom_ids, key=index.names.__getitem__):
+        out.write("%s\t%s\n"%(index.names[dom_id], index.is_valid_dom(dom_id)))
     out.close()
 
 #-----------------------------------------------------------------------------------------------------------------------
 
 
-def export_doms(dom_lkp, valid_doms, path):
+def export_doms(index, path):
     '''Write out identified architectures in markdown tables.
     Inputs:
-    dom_lkp -- dictionary of domains occuring in multi-domain architectures.
+    index -- ArchIndex of the eligible targets
     '''
-    sorted_doms = sorted(dom_lkp.iteritems(), key=operator.itemgetter(1), reverse= True)
+    lkp = index.dom_targets
+    sorted_doms = sorted(lkp.keys(), key=lambda x: (-lkp[x], index.names[x]))
     out = open('%s.md' % path ,'w')
     out.write('|domain |count| validated|\n')
     out.write('|:-----------|:-----|-------:|\n')
-    for dom in sorted_doms:
-        mapped = False
-        count = dom[1]
-        dom = str(dom[0])
-        if dom in valid_doms:
-            mapped = True
-        out.write("|%s|%s|%s|\n"%(dom, count, mapped))
+    for dom_id in sorted_doms:
+        out.write("|%s|%s|%s|\n"%(index.names[dom_id], lkp[dom_id], index.is_valid_dom(dom_id)))
+    out.close()
+
+#-----------------------------------------------------------------------------------------------------------------------
+
+def sweep(thresholds, versions):
+    """
+    Function:  sweep
+    Count covered architectures and activities for each threshold and each
+    version of the validated domains, from a single query of bucketed
+    activity counts. Writes one line per (version, threshold) to
+    data/coverage_sweep_<release>.tab.
+    Inputs:
+    thresholds -- list of thresholds in uM
+    versions -- list of versions of data/valid_pfam_v_%(version)s.tab
+    """
+    report = instrument.Report('coverage_sweep', params)
+    thresholds = sorted(thresholds)
+    with report.stage('read') as stage:
+        valid_doms = {}
+        for version in versions:
+            valid_doms[version] = tabfile.read_keys('data/valid_pfam_v_%(version)s.tab' % locals(), 'domain_name', str)
+            stage['rows'] += len(valid_doms[version])
+    with report.stage('targets') as stage:
+        buckets = get_el_target_buckets(thresholds, params)
+        stage['rows'] = len(buckets)
+    with report.stage('doms') as stage:
+        pfam_lkp = get_doms(set([x[0] for x in buckets]), params)
+        stage['rows'] = len(pfam_lkp)
+    with report.stage('sweep') as stage:
+        counts = {}
+        for ent in buckets:
+            key = tuple(ent[:3])
+            if key not in counts:
+                counts[key] = [0] * len(thresholds)
+            counts[key][ent[3]] += ent[4]
+        rows = []
+        for i, threshold in enumerate(thresholds):
+            el_targets = []
+            for key in counts.keys():
+                act_count = sum(counts[key][:i + 1])
+                if act_count:
+                    el_targets.append(key + (None, act_count))
+            index = get_archs(el_targets, pfam_lkp, [])
+            for version in versions:
+                mask = index.mask(valid_doms[version])
+                (valid_targets, all_targets, valid_archs, all_archs) = index.coverage(index.targets, mask)
+                (valid_acts, all_acts) = index.coverage(index.acts, mask)[:2]
+                rows.append((version, threshold, valid_targets, all_targets, valid_acts, all_acts, valid_archs, all_archs))
+        stage['rows'] = len(rows)
+    with report.stage('write') as stage:
+        out = open('data/coverage_sweep_%s.tab' % params['release'], 'w')
+        out.write('release\tversion\tthreshold\tvalid_targets\tall_targets\tvalid_acts\tall_acts\tvalid_archs\tall_archs\n')
+        release = params['release']
+        for row in sorted(rows):
+            out.write('%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\n' % ((release,) + row))
+        out.close()
+        stage['rows'] = len(rows)
+    print "connections opened: %(opened)i, reused: %(reused)i" % pg2_wrapper.stats
+    print "run report: ", report.write()
+    pg2_wrapper.close_pools()
 
 #-----------------------------------------------------------------------------------------------------------------------
 
@@ -270,27 +320,45 @@ def master(version):
     Function:  master
     Run through all steps to identify mandatory muli-domain architectures.
     """
+    report = instrument.Report('coverage', params)
     # Load the list of validated domains.
-    valid_dom_d = readfile('data/valid_pfam_v_%(version)s.tab' % locals(), 'pfam_a', 'pfam_a')
-    valid_doms = valid_dom_d.keys()
+    with report.stage('read') as stage:
+        valid_doms = tabfile.read_keys('data/valid_pfam_v_%(version)s.tab' % locals(), 'domain_name', str)
+        stage['rows'] = len(valid_doms)
     ## Load eligible targets.
-    el_targets = get_el_targets(params)
+    with report.stage('targets') as stage:
+        el_targets = get_el_targets(params)
+        stage['rows'] = len(el_targets)
     ## Get domains for tids.
-    pfam_lkp = get_doms([x[0] for x in el_targets], params)
+    with report.stage('doms') as stage:
+        pfam_lkp = get_doms([x[0] for x in el_targets], params)
+        stage['rows'] = len(pfam_lkp)
     ## Add targets with given architecture.
-    (arch_lkp, dom_lkp, act_lkp) = get_archs(el_targets, pfam_lkp)
-    ## Count covered acrchitectures.
-    count_valid(arch_lkp, valid_doms)
-    ## Count covered activities.
-    count_valid(act_lkp, valid_doms)
-    ##  Write multi-domain architechtures to markdown tables.
-    export_archs(arch_lkp, valid_doms, 'data/multi_dom_archs_%s'% params['release'])
-    ## Write domains from multi-domain architechtures to markdown tables.
-    export_doms(dom_lkp, valid_doms, 'data/multi_dom_doms_%s'% params['release'])
-    ## export network file.
-    export_network(arch_lkp, valid_doms, 'data/multi_dom_network_%s'% params['release'])
-    ## export network attribute file.
-    export_attribs(arch_lkp, valid_doms, 'data/multi_dom_attributes_%s'% params['release'])
+    with report.stage('map') as stage:
+        index = get_archs(el_targets, pfam_lkp, valid_doms)
+        stage['rows'] = len(index.doms)
+    with report.stage('count'):
+        ## Count covered acrchitectures.
+        count_valid(index, index.targets)
+        ## Count covered activities.
+        count_valid(index, index.acts)
+    with report.stage('write'):
+        ##  Write multi-domain architechtures to markdown tables.
+        export_archs(index, 'data/multi_dom_archs_%s'% params['release'])
+        ## Write domains from multi-domain architechtures to markdown tables.
+        export_doms(index, 'data/multi_dom_doms_%s'% params['release'])
+        if params.get('graph_engine') == 'numpy':
+            ## export network and attribute files from the sparse graph.
+            domain_graph.export(index, 'data/multi_dom_network_%s'% params['release'],
+                                'data/multi_dom_attributes_%s'% params['release'], params.get('network_format', 'tab'))
+        else:
+            ## export network file.
+            export_network(index, 'data/multi_dom_network_%s'% params['release'])
+            ## export network attribute file.
+            export_attribs(index, 'data/multi_dom_attributes_%s'% params['release'])
+    print "connections opened: %(opened)i, reused: %(reused)i" % pg2_wrapper.stats
+    print "run report: ", report.write()
+    pg2_wrapper.close_pools()
 
 
 #-----------------------------------------------------------------------------------------------------------------------
@@ -301,7 +369,12 @@ if __name__ == '__main__':
 
         if len(sys.argv) != 2: # the program name and one argument
                 sys.exit("""Parameters are read from mpf.yaml but must specify
-		 	    version for data/valid_pfam_v_%(version)s.tab""")
-        version = sys.argv[1]
-
-        master(version)
+		 	    version for data/valid_pfam_v_%(version)s.tab,
+			    or sweep to cover all versions and sweep_thresholds""")
+        if sys.argv[1] == 'sweep':
+                import glob
+                versions = sorted([x[len('data/valid_pfam_v_'):-len('.tab')] for x in glob.glob('data/valid_pfam_v_*.tab')])
+                sweep(params.get('sweep_thresholds', [0.01, 0.1, 1, 10, 100]), versions)
+        else:
+                version = sys.argv[1]
+                master(version)
@@ -0,0 +1,146 @@
+"""Script:  domain_graph.py
+
+Sparse co-occurrence graph of the domains in multi-domain architectures, for
+coverage.py. The architectures of an arch_index.ArchIndex are grouped by
+length and all domain pairs of a group are taken at once, giving COO arrays
+over the interned domain ids; pairs are summed into a CSR matrix weighted by
+the number of targets. Select it with graph_engine: numpy in local.yaml and
+pick the edge output with network_format:
+    tab     -- edge file as written by export_network
+    npz     -- the CSR arrays, domain names and validity flags in one .npz file
+    graphml -- one GraphML file with a valid attribute on nodes and count on edges
+The node file of export_attribs is written with every format.
+
+--------------------
+Author:
+Felix Kruger
+fkrueger@ebi.ac.uk
+"""
+from xml.sax.saxutils import quoteattr
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def build(index):
+    """Build the weighted domain graph.
+
+    Inputs:
+    index -- ArchIndex of the eligible targets
+
+    Returns a dictionary holding the CSR matrix (indptr, indices, data) over
+    the domain ids, the domain names, a validity flag per domain and the
+    ids of the domains in the graph (nodes). Edges point from the domain
+    that sorts first by name to the other; repeated domains give self-loops.
+
+    """
+    if np is None:
+        raise ImportError('graph_engine: numpy requires the numpy package')
+    n = len(index.names)
+    by_len = {}
+    for idx in index.multi():
+        by_len.setdefault(len(index.doms[idx]), []).append(idx)
+    rows = [np.zeros(0, dtype=np.int_)]
+    cols = [np.zeros(0, dtype=np.int_)]
+    weights = [np.zeros(0, dtype=np.int_)]
+    for length in sorted(by_len.keys()):
+        idxs = by_len[length]
+        doms = np.array([index.doms[idx] for idx in idxs], dtype=np.int_)
+        (i, j) = np.triu_indices(length, 1)
+        rows.append(doms[:, i].ravel())
+        cols.append(doms[:, j].ravel())
+        weights.append(np.repeat(np.array([index.targets[idx] for idx in idxs], dtype=np.int_), len(i)))
+    rows = np.concatenate(rows)
+    cols = np.concatenate(cols)
+    weights = np.concatenate(weights)
+    # Sum the weights of repeated pairs; the keys come back in row-major order.
+    (keys, inverse) = np.unique(rows * n + cols, return_inverse=True)
+    data = np.bincount(inverse, weights=weights, minlength=len(keys)).astype(np.int_)
+    rows = keys // n
+    indptr = np.zeros(n + 1, dtype=np.int_)
+    np.cumsum(np.bincount(rows, minlength=n), out=indptr[1:])
+    return {'indptr': indptr,
+            'indices': keys % n,
+            'data': data,
+            'names': index.names,
+            'valid': np.array([index.is_valid_dom(x) for x in range(n)], dtype=bool),
+            'nodes': np.union1d(rows, keys % n)}
+
+
+def edges(graph):
+    """Return the rows, columns and weights of the graph in COO form, ordered
+    by the names of both domains."""
+    names = graph['names']
+    rows = np.repeat(np.arange(len(graph['indptr']) - 1), np.diff(graph['indptr']))
+    cols = graph['indices']
+    rank = np.empty(len(names), dtype=np.int_)
+    rank[sorted(range(len(names)), key=names.__getitem__)] = np.arange(len(names))
+    order = np.lexsort((rank[cols], rank[rows]))
+    return (rows[order], cols[order], graph['data'][order])
+
+
+def nodes(graph):
+    """Return the ids of the domains in the graph ordered by name."""
+    names = graph['names']
+    return sorted(graph['nodes'].tolist(), key=names.__getitem__)
+
+
+def write_tab(graph, network_path):
+    """Write the edge file <network_path>.tab."""
+    names = graph['names']
+    (rows, cols, data) = edges(graph)
+    out = open('%s.tab' % network_path, 'w')
+    out.write('dom_1\tdom_2\tcount\n')
+    out.writelines(["%s\t%s\t%s\n" % (names[r], names[c], d) for (r, c, d) in zip(rows.tolist(), cols.tolist(), data.tolist())])
+    out.close()
+
+
+def write_attribs(graph, attribs_path):
+    """Write the node file <attribs_path>.tab."""
+    names = graph['names']
+    valid = graph['valid']
+    out = open('%s.tab' % attribs_path, 'w')
+    out.write('dom\tvalid\n')
+    out.writelines(["%s\t%s\n" % (names[x], bool(valid[x])) for x in nodes(graph)])
+    out.close()
+
+
+def write_npz(graph, network_path):
+    """Write the CSR arrays, domain names and flags to <network_path>.npz."""
+    np.savez_compressed('%s.npz' % network_path, indptr=graph['indptr'], indices=graph['indices'],
+                        data=graph['data'], names=np.array(graph['names']), valid=graph['valid'],
+                        nodes=graph['nodes'])
+
+
+def write_graphml(graph, network_path):
+    """Write the graph to <network_path>.graphml, nodes identified by domain name."""
+    names = graph['names']
+    valid = graph['valid']
+    (rows, cols, data) = edges(graph)
+    out = open('%s.graphml' % network_path, 'w')
+    out.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+    out.write('<graphml xmlns="http://graphml.graphdrawing.org/xmlns">\n')
+    out.write('  <key id="valid" for="node" attr.name="valid" attr.type="boolean"/>\n')
+    out.write('  <key id="count" for="edge" attr.name="count" attr.type="int"/>\n')
+    out.write('  <graph id="multi_dom_network" edgedefault="undirected">\n')
+    out.writelines(['    <node id=%s><data key="valid">%s</data></node>\n' % (quoteattr(names[x]), str(bool(valid[x])).lower())
+                    for x in nodes(graph)])
+    out.writelines(['    <edge source=%s target=%s><data key="count">%s</data></edge>\n' % (quoteattr(names[r]), quoteattr(names[c]), d)
+                    for (r, c, d) in zip(rows.tolist(), cols.tolist(), data.tolist())])
+    out.write('  </graph>\n</graphml>\n')
+    out.close()
+
+
+def export(index, network_path, attribs_path, network_format='tab'):
+    """Build the graph of index, write its edges in network_format and its
+    nodes to the attribute file."""
+    graph = build(index)
+    if network_format == 'npz':
+        write_npz(graph, network_path)
+    elif network_format == 'graphml':
+        write_graphml(graph, network_path)
+    else:
+        write_tab(graph, network_path)
+    write_attribs(graph, attribs_path)
+    return graph
@@ -11,48 +11,63 @@ fkrueger@ebi.ac.uk
 """
 import os
 import sys
-import time
 import pg2_wrapper
+import instrument
+import rowwriter
+import snapshot_store
+import tabfile
 import yaml
 
 
 def retrieve_acts(params):
-    """Run a query to obtain manual mappings.
+    """Run a query to obtain manual mappings. Rows are streamed from a
+    server-side cursor and returned as an iterator.
 
     Inputs:
     params -- dictionary holding details of the connection string
 
     """
-    acts = pg2_wrapper.sql_query("SELECT * from pfam_maps WHERE manual_flag = 1 ", locals() ,params)
+    acts = pg2_wrapper.sql_query_iter("SELECT * from pfam_maps WHERE manual_flag = 1 ", locals() ,params)
     return acts
 
 
-def write_table(acts, path):
-    """ Export the manual mappings into the manual_pfam_maps_v_x_x.tab file to be fed into the next round of curation.
+MANUAL_COLUMNS = ('activity_id', 'compd_id', 'domain_name', 'category_flag', 'status_flag', 'manual_flag',
+                  'comment', 'timestamp', 'submitter', 'domain_id')
+
+
+def copy_acts(path, params):
+    """ Stream the manual mappings into path with COPY ... TO STDOUT, in the
+    column order of write_table, without building rows in Python. Returns
+    the number of rows.
 
     Input:
-    acts -- results of the manual query
-    path -- a filepath to the output file
+    path -- a filepath to the output file, compressed if it ends in .gz or .zst
+    params -- dictionary holding details of the connection string
 
     """
-    out = open(path, 'w')
-    out.write("""activity_id\tcompd_id\tdomain_name\tcategory_flag\tstatus_flag\tmanual_flag\tcomment\ttimestamp\tsubmitter\tdomain_id\n""")
-    for act in acts:
-        # map_id = act[0] this value is generated from scratch in load.py
-        act_id = act[1]
-        compd_id = act[2]
-        domain_name = act[3]
-        category_flag = act[4]
-        status_flag = act[5]
-        manual_flag = act[6]
-        comment = act[7]
-        timestamp = act[8]
-        submitter = act[9]
-        domain_id = act[10]
-        out.write("""%(act_id)i\t%(compd_id)i\t%(domain_name)s\t%(category_flag)i\t%(status_flag)i\t%(manual_flag)i\t%(comment)s\t%(timestamp)s\t%(submitter)s\t%(domain_id)s\n"""%locals())
-    out.close()
+    out = rowwriter.open_output(path, params.get('compress_threads', 1))
+    try:
+        out.write('\t'.join(MANUAL_COLUMNS) + '\n')
+        rows = pg2_wrapper.sql_copy_out("SELECT %s FROM pfam_maps WHERE manual_flag = 1" % ', '.join(MANUAL_COLUMNS), out, params)
+    finally:
+        out.close()
+    return rows
+
 
+def write_table(acts, path, params=None):
+    """ Export the manual mappings into the manual_pfam_maps_v_x_x.tab file to be fed into the next round of curation.
+
+    Input:
+    acts -- results of the manual query
+    path -- a filepath to the output file, compressed if it ends in .gz or .zst
+    params -- dictionary holding write_batch and compress_threads
 
+    """
+    params = params or {}
+    # map_id = act[0] this value is generated from scratch in load.py
+    rows = (tuple(act[1:11]) for act in acts)
+    rowwriter.write_buffers(rowwriter.format_rows(rows, rowwriter.MAPS_LINE, params.get('write_batch', 10000)),
+                            path, rowwriter.MAPS_HEADER, params)
 
 
 def exporter():
@@ -62,17 +77,45 @@ def exporter():
     #param_file = open('example.yaml')
     params = yaml.safe_load(param_file)
     param_file.close()
-
-    # Get activities for domains.
-    acts  = retrieve_acts(params)
+    report = instrument.Report('exporter', params)
 
     # Write activity on new manual_pfam_maps file
-    path = 'data/manual_pfam_maps_v_%(version)s.tab' %params
-    write_table(acts, path)
+    plain_path = 'data/manual_pfam_maps_v_%(version)s.tab' %params
+    path = plain_path
+    compression = params.get('export_compression', 'none')
+    if compression == 'none' and params.get('export_gzip'):
+        compression = 'gzip'
+    if compression == 'gzip':
+        path += '.gz'
+    elif compression == 'zstd':
+        path += '.zst'
+    with report.stage('write') as stage:
+        if params.get('export_mode') == 'copy':
+            stage['rows'] = copy_acts(path, params)
+        else:
+            # Get activities for domains.
+            acts  = retrieve_acts(params)
+            write_table(acts, path, params)
+        stage['bytes'] = os.path.getsize(path)
+    # Remove the table of an earlier export in another compression.
+    for stale_path in (plain_path, plain_path + '.gz', plain_path + '.zst'):
+        if stale_path != path and os.path.exists(stale_path):
+            os.remove(stale_path)
+    if params.get('store_snapshot'):
+        # Keep the new version in the snapshot store as a delta.
+        with report.stage('snapshot') as stage:
+            infile = tabfile.open_tab(path)
+            try:
+                stage['rows'] = snapshot_store.add(plain_path, infile)
+            finally:
+                infile.close()
+
+    print "connections opened: %(opened)i, reused: %(reused)i" % pg2_wrapper.stats
+    print "run report: ", report.write()
+    pg2_wrapper.close_pools()
 
 
 if __name__ == '__main__':
-    import sys
     if len(sys.argv) != 1:  # the program name and the two arguments
         sys.exit("All parameters are specified in local.yaml or example.yaml ")
 
@@ -0,0 +1,166 @@
+"""Script:  instrument.py
+
+Per-stage timing for loader.loader, exporter.exporter and coverage.master.
+Each stage records wall time, rows processed, bytes written, resident
+memory and how much the peak resident memory of the process rose during the
+stage (peak_growth_mb, zero if the stage stayed below an earlier peak); time
+spent in pg2_wrapper queries during a stage is split out into query and
+fetch entries. Queries are counted per thread, so concurrent stages only
+count their own and those of the threads working for them (see
+pg2_wrapper.share_counters). One JSON report is written per run into
+params['report_dir'].
+
+With profile: cprofile in local.yaml the whole run is profiled and the stats
+are dumped next to the report; with profile: tracemalloc (Python 3 only) the
+largest allocation sites are added to the report. Under Python 2 it falls
+back to the resident memory of each stage and the rise of the peak during
+it, with a warning.
+
+--------------------
+Author:
+Felix Kruger
+fkrueger@ebi.ac.uk
+"""
+import contextlib
+import json
+import os
+import resource
+import threading
+import time
+import pg2_wrapper
+
+
+def rss_kb():
+    """Current resident set size in kB, read from /proc on Linux."""
+    try:
+        with open('/proc/self/statm') as infile:
+            return int(infile.read().split()[1]) * resource.getpagesize() // 1024
+    except IOError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def peak_rss_kb():
+    """Peak resident set size of the process in kB, since the last
+    reset_peak on Linux and since it started otherwise."""
+    try:
+        with open('/proc/self/status') as infile:
+            for line in infile:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def reset_peak():
+    """Reset the peak resident set size to the current one, on Linux.
+    Returns whether it was reset."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as out:
+            out.write('5')
+        return True
+    except IOError:
+        return False
+
+
+class Report(object):
+    """
+    Collects the stages of one run and writes them as a JSON report.
+    """
+    def __init__(self, script, params):
+        self.script = script
+        self.params = params
+        self.started = time.time()
+        self.stages = []
+        # Stages are appended from the threads of concurrent uploads.
+        self.lock = threading.Lock()
+        self.info = {}
+        self.profiler = None
+        self.tracemalloc = None
+        pg2_wrapper.reset_stats()
+        profile = params.get('profile')
+        if profile == 'cprofile':
+            import cProfile
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        elif profile == 'tracemalloc':
+            try:
+                import tracemalloc
+            except ImportError:
+                # Python 2: the stages still record resident memory and peak growth.
+                print "warning: profile: tracemalloc needs Python 3, only resident memory is reported"
+                self.info['profile_warning'] = 'tracemalloc is not available, only resident memory is reported'
+            else:
+                self.tracemalloc = tracemalloc
+                tracemalloc.start()
+
+    @contextlib.contextmanager
+    def stage(self, name, **info):
+        """
+        Time the enclosed block as stage name. The yielded dictionary can
+        be used to set rows and bytes; further keyword arguments are stored
+        with the stage.
+        """
+        entry = {'stage': name, 'rows': 0, 'bytes': 0}
+        entry.update(info)
+        db = pg2_wrapper.thread_stats()
+        peak = peak_rss_kb()
+        start = time.time()
+        try:
+            yield entry
+        finally:
+            entry['seconds'] = round(time.time() - start, 4)
+            entry['rss_mb'] = round(rss_kb() / 1024.0, 1)
+            entry['peak_growth_mb'] = round(max(peak_rss_kb() - peak, 0) / 1024.0, 1)
+            db_seconds = 0.0
+            db_stages = []
+            stats = pg2_wrapper.thread_stats()
+            for key in ('query', 'fetch'):
+                seconds = stats['%s_seconds' % key] - db['%s_seconds' % key]
+                if seconds > 0:
+                    db_seconds += seconds
+                    db_stages.append({'stage': key, 'parent': name, 'seconds': round(seconds, 4),
+                                      'rows': stats['rows_fetched'] - db['rows_fetched'] if key == 'fetch' else 0,
+                                      'bytes': 0})
+            entry['self_seconds'] = round(max(entry['seconds'] - db_seconds, 0), 4)
+            with self.lock:
+                self.stages.extend(db_stages)
+                self.stages.append(entry)
+
+    def count(self, lines, entry):
+        """
+        Pass lines through, adding their number and length to the rows and
+        bytes of a stage entry.
+        """
+        for line in lines:
+            entry['rows'] += 1
+            entry['bytes'] += len(line)
+            yield line
+
+    def write(self):
+        """
+        Write the report and return its filepath.
+        """
+        stamp = time.strftime('%Y%m%d_%H%M%S', time.gmtime(self.started))
+        path = os.path.join(self.params.get('report_dir', 'data'), '%s_%s_%s.json' % (self.script, self.params.get('release'), stamp))
+        report = {'script': self.script,
+                  'release': self.params.get('release'),
+                  'version': self.params.get('version'),
+                  'started': time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(self.started)),
+                  'seconds': round(time.time() - self.started, 4),
+                  'peak_rss_mb': round(peak_rss_kb() / 1024.0, 1),
+                  'connections': {'opened': pg2_wrapper.stats['opened'], 'reused': pg2_wrapper.stats['reused']},
+                  'stages': self.stages}
+        report.update(self.info)
+        if self.profiler is not None:
+            self.profiler.disable()
+            report['profile'] = path[:-len('.json')] + '.prof'
+            self.profiler.dump_stats(report['profile'])
+        if self.tracemalloc is not None:
+            snapshot = self.tracemalloc.take_snapshot()
+            report['tracemalloc'] = [{'site': str(stat.traceback), 'size_kb': stat.size // 1024, 'count': stat.count}
+                                     for stat in snapshot.statistics('lineno')[:25]]
+            self.tracemalloc.stop()
+        with open(path, 'w') as out:
+            json.dump(report, out, indent=2, sort_keys=True)
+        return path
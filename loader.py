@@ -2,6 +2,9 @@
 
 Load the mapping of Pfam-A domains. The main function is loader, defined at the bottom of the document. Specify release and version of the mapping on command line. eg.: $> python loader.py chembl_15 0_1
 
+To load several releases in parallel, list them, optionally with a version, eg.: $> python loader.py batch chembl_20 chembl_21 chembl_22:1_5
+or set batch_releases in local.yaml. See batch.
+
 Note on variable names: lkp is used to represent dictionaries I was too lazy to find a proper name for.
 
 --------------------
@@ -9,52 +12,27 @@ Author:
 Felix Kruger
 fkrueger@ebi.ac.uk
 """
+import json
+import multiprocessing
 import os
+import Queue
+import threading
+import time
 from subprocess import Popen, PIPE
+from multiprocessing.pool import ThreadPool
 import sys
 import yaml
 import pg2_wrapper
+import array_maps
+import tabfile
+import instrument
+import query_cache
+import checkpoint
+import rowwriter
 import shlex
 
 
-def readfile(path, key_name, val_name):
-    '''Read two columns from a tab-separated file into a dictionary.
-
-    Inputs:
-    path -- filepath
-    key_name -- name of the column holding the key
-    val_name -- name of the column holding the value
-
-    '''
-    infile = open(path, 'r')
-    lines = infile.readlines()
-    infile.close()
-    lkp = {}
-    els = lines[0].rstrip().split('\t')
-    for i, el in enumerate(els):
-        if el == key_name:
-            key_idx = i
-        if el == val_name:
-            val_idx = i
-    for line in lines[1:]:
-        elements = line.rstrip().split('\t')
-        lkp[elements[key_idx]] = elements[val_idx]
-    return  lkp
-
-
-def get_acts(domains, params):
-    """Run a query for act_id, tid, component_id, compd_id and domain_name.
-       This is to identify all activities associated with any given valid
-       domain. These activities are then processed with the map_ints and
-       flag_conflicts function.
-
-    Inputs:
-    dom_string -- A string specifying the domain names eg. "7tm_1','Pkinase','Pkinase_tyr"
-    params -- dictionary holding details of the connection string
-
-    """
-    acts = pg2_wrapper.sql_query("""
-    SELECT DISTINCT act.activity_id, ass.tid, tc.component_id, cd.compd_id, dm.domain_name, dm.domain_id
+ACTS_JOIN = """
                       FROM activities act
                       JOIN assays ass
                           ON ass.assay_id = act.assay_id
@@ -70,15 +48,67 @@ def get_acts(domains, params):
                      AND td.target_type IN('PROTEIN COMPLEX', 'SINGLE PROTEIN')
                      AND ass.relationship_type = 'D'
                      AND act.pchembl_value IS NOT NULL
-                     AND dm.domain_id IN %(domains)s
-                     """ ,locals() ,params )
+                     AND dm.domain_id = ANY(%(domains)s)
+                     """
+
+def get_acts(domains, params):
+    """Run a query for act_id, tid, component_id, compd_id and domain_name.
+       This is to identify all activities associated with any given valid
+       domain. These activities are then processed with the map_ints and
+       flag_conflicts function. Rows are streamed from a server-side cursor,
+       or from the query cache if cache_dir is set, and returned as an
+       iterator.
+
+    Inputs:
+    domains -- sequence of valid domain_ids, passed as an array parameter
+    params -- dictionary holding details of the connection string
+
+    """
+    domains = [int(x) for x in domains]
+    acts = query_cache.sql_query_iter("""
+    SELECT DISTINCT act.activity_id, ass.tid, tc.component_id, cd.compd_id, dm.domain_name, dm.domain_id
+                     %s""" % ACTS_JOIN ,locals() ,params )
+    return acts
+
+def get_flagged_acts(domains, params):
+    """Run the query of get_acts with the conflict flags computed
+       server-side, grouping by activity_id in the same way as map_ints and
+       flag_conflicts. Returns an iterator over one row per activity_id and
+       compd_id: (act_id, compd_id, domain_name, category_flag, status_flag,
+       manual_flag, domain_id).
+
+    Inputs:
+    domains -- sequence of valid domain_ids, passed as an array parameter
+    params -- dictionary holding details of the connection string
+
+    """
+    domains = [int(x) for x in domains]
+    acts = pg2_wrapper.sql_query_iter("""
+    WITH pairs AS (
+                     SELECT DISTINCT act.activity_id, cd.compd_id, dm.domain_name, dm.domain_id
+                     %s
+                     )
+    SELECT p.activity_id, p.compd_id, p.domain_name, f.category_flag, f.status_flag, 0, p.domain_id
+                      FROM pairs p
+                      JOIN (
+                            SELECT activity_id,
+                                   CASE WHEN COUNT(DISTINCT compd_id) = 1 THEN 0
+                                        WHEN COUNT(DISTINCT domain_id) > 1 THEN 2
+                                        ELSE 1 END AS category_flag,
+                                   CASE WHEN COUNT(DISTINCT compd_id) = 1 THEN 0
+                                        ELSE 1 END AS status_flag
+                            FROM pairs
+                            GROUP BY activity_id
+                           ) AS f
+                          ON f.activity_id = p.activity_id
+                     """ % ACTS_JOIN ,locals() ,params )
     return acts
 
 def map_ints(acts):
     """ Map interactions to activity ids.
 
     Inputs:
-    acts -- output of the sql query in retrieve_acts().
+    acts -- output of the sql query in get_acts(), any iterable of rows.
 
     """
     lkp = {}
@@ -91,6 +121,101 @@ def map_ints(acts):
             lkp[act_id][compd_id]=(domain_id, domain_name)
     return lkp
 
+def map_partition(args):
+    """ Run get_acts and map_ints for one chunk of domains. Returns the
+    partial lookup, the elapsed time and the number of rows fetched.
+
+    Inputs:
+    args -- tuple of (domains, params)
+
+    """
+    (domains, params) = args
+    counter = {'rows': 0}
+    start = time.time()
+    lkp = map_ints(count_rows(get_acts(domains, params), counter))
+    return (lkp, time.time() - start, counter['rows'])
+
+def fetch_partition(args):
+    """ Run get_acts for one chunk of domains and stream its rows into the
+    integer columns of array_maps.collect. Returns the columns, the elapsed
+    time and the number of rows fetched.
+
+    Inputs:
+    args -- tuple of (domains, params)
+
+    """
+    (domains, params) = args
+    start = time.time()
+    columns = array_maps.collect(get_acts(domains, params))
+    return (columns, time.time() - start, len(columns[0]))
+
+def run_partitioned(func, domains, params):
+    """ Split the domains into params['partitions'] chunks and run func on
+    (chunk, params) for the chunks concurrently, each on its own
+    connection. Returns the results in chunk order.
+
+    Inputs:
+    func -- map_partition or fetch_partition
+    domains -- tuple of valid domain_ids
+    params -- dictionary holding details of the connection string
+
+    """
+    n = params.get('partitions', 1)
+    chunks = [domains[i::n] for i in range(n)]
+    chunks = [chunk for chunk in chunks if chunk]
+    if not chunks:
+        return []
+    # Count the queries of the workers in the stage of the calling thread.
+    workers = ThreadPool(min(len(chunks), params.get('pool_size', 4)),
+                         pg2_wrapper.share_counters, (pg2_wrapper.thread_counters(),))
+    try:
+        results = workers.map(func, [(chunk, params) for chunk in chunks])
+    finally:
+        workers.close()
+        workers.join()
+    for i, (part, elapsed, n_rows) in enumerate(results):
+        print "partition %i: %i domains, %i rows in %.1f s" % (i, len(chunks[i]), n_rows, elapsed)
+    return [part for (part, elapsed, n_rows) in results]
+
+def get_columns_partitioned(domains, params):
+    """ Run get_acts for params['partitions'] chunks of the domains
+    concurrently, each streamed into integer columns, and join the columns
+    chunk after chunk for array_maps.map_columns. Mapped, these give the
+    lines of get_acts_partitioned, though not in the same order: that merges
+    the lookups of the chunks in dictionary order.
+
+    Inputs:
+    domains -- tuple of valid domain_ids
+    params -- dictionary holding details of the connection string
+
+    """
+    parts = run_partitioned(fetch_partition, domains, params)
+    columns = array_maps.collect([])
+    while parts:
+        # Release each chunk once it is joined.
+        array_maps.extend(columns, parts.pop(0))
+    return columns
+
+def get_acts_partitioned(domains, params):
+    """ Split the domains into params['partitions'] chunks, run get_acts and
+    map_ints for the chunks concurrently, each on its own connection, and
+    merge the partial results into one lookup of the form
+    lkp[act_id][compd_id] = (domain_id, domain_name).
+
+    Inputs:
+    domains -- tuple of valid domain_ids
+    params -- dictionary holding details of the connection string
+
+    """
+    lkp = {}
+    for part in run_partitioned(map_partition, domains, params):
+        for act_id in part.keys():
+            try:
+                lkp[act_id].update(part[act_id])
+            except KeyError:
+                lkp[act_id] = part[act_id]
+    return lkp
+
 def flag_conflicts(lkp):
     """Assign a set of flags to each activity: category, status, manual.
 
@@ -109,27 +234,143 @@ def flag_conflicts(lkp):
                 flag_lkp[act_id] = (1,1,0) # multiple instances of one val. dom.
     return flag_lkp
 
-def write_table(lkp, flag_lkp, manuals, params, path):
-    """ Write a table containing activity_id, domain_id, tid, conflict_flag, type_flag.
+MAPS_HEADER = rowwriter.MAPS_HEADER
+MAPS_LINE = rowwriter.MAPS_LINE
+
+def format_rows(lkp, flag_lkp, manuals, params):
+    """ Generate the lines of the automatic mapping table, without header.
 
     Input:
     lkp -- a dictionary of the form lkp[act_id][compd_id] = domain_name
     flag_lkp -- a dictionary of the form flag_lkp[act_id] = (conflict_flag, manual_flag)
-    path -- a filepath to the output file
+    manuals -- set of the activity_ids of manual mappings
 
     """
-    out = open(path, 'w')
-    out.write("""activity_id\tcompd_id\tdomain_name\tcategory_flag\tstatus_flag\tmanual_flag\tcomment\ttimestamp\tsubmitter\tdomain_id\n""")
-    for act_id in set(map(int, lkp.keys())) - set(map(int, manuals.keys())): # Not processing maunal maps.
+    comment = params['comment']
+    timestamp = params['timestamp']
+    submitter = params['submitter']
+    for act_id in set(map(int, lkp.keys())) - manuals: # Not processing maunal maps.
         compd_ids = lkp[act_id]
         (category_flag, status_flag, manual_flag) = flag_lkp[act_id]
-        comment = params['comment']
-        timestamp = params['timestamp']
-        submitter = params['submitter']
         for compd_id in compd_ids.keys():
             (domain_id, domain_name) = lkp[act_id][compd_id]
-            out.write("""%(act_id)i\t%(compd_id)i\t%(domain_name)s\t%(category_flag)i\t%(status_flag)i\t%(manual_flag)i\t%(comment)s\t%(timestamp)s\t%(submitter)s\t%(domain_id)s\n"""%locals())
-    out.close()
+            yield MAPS_LINE % (act_id, compd_id, domain_name, category_flag, status_flag, manual_flag, comment, timestamp, submitter, domain_id)
+
+def format_flagged_rows(acts, manuals, params):
+    """ Generate the lines of the automatic mapping table, without header,
+    from the rows of get_flagged_acts. The lines are those of format_rows,
+    in the order the server returns them.
+
+    Input:
+    acts -- output of get_flagged_acts()
+    manuals -- set of the activity_ids of manual mappings
+
+    """
+    comment = params['comment']
+    timestamp = params['timestamp']
+    submitter = params['submitter']
+    for act in acts:
+        (act_id, compd_id, domain_name, category_flag, status_flag, manual_flag, domain_id) = act
+        if act_id in manuals: # Not processing maunal maps.
+            continue
+        yield MAPS_LINE % (act_id, compd_id, domain_name, category_flag, status_flag, manual_flag, comment, timestamp, submitter, domain_id)
+
+def count_rows(rows, counter):
+    """ Pass rows through, counting them in counter['rows']. """
+    for row in rows:
+        counter['rows'] += 1
+        yield row
+
+def compare_classification(domains, manuals, params):
+    """ Run the Python and the server-side classification and report wall
+    time, rows transferred from the server and whether both produce the same
+    mapping. Returns the timings and the lines of the Python
+    classification, so that they can be loaded without fetching again.
+
+    Input:
+    domains -- tuple of valid domain_ids
+    manuals -- set of the activity_ids of manual mappings
+
+    """
+    python = {'rows': 0}
+    start = time.time()
+    lkp = map_ints(count_rows(get_acts(domains, params), python))
+    flag_lkp = flag_conflicts(lkp)
+    python_lines = list(format_rows(lkp, flag_lkp, manuals, params))
+    python['time'] = time.time() - start
+    del lkp, flag_lkp
+
+    server = {'rows': 0}
+    start = time.time()
+    server_lines = set(format_flagged_rows(count_rows(get_flagged_acts(domains, params), server), manuals, params))
+    server['time'] = time.time() - start
+
+    print "python classification: %(rows)i rows transferred in %(time).1f s" % python
+    print "server classification: %(rows)i rows transferred in %(time).1f s" % server
+    print "mappings identical: ", set(python_lines) == server_lines
+    return (python, server, python_lines)
+
+def write_table(lkp, flag_lkp, manuals, params, path):
+    """ Write a table containing activity_id, domain_id, tid, conflict_flag, type_flag.
+
+    Input:
+    lkp -- a dictionary of the form lkp[act_id][compd_id] = domain_name
+    flag_lkp -- a dictionary of the form flag_lkp[act_id] = (conflict_flag, manual_flag)
+    path -- a filepath to the output file
+
+    """
+    write_rows(format_rows(lkp, flag_lkp, manuals, params), path, params)
+
+def write_rows(rows, path, params=None):
+    """ Write the lines generated by format_rows to path, preceded by the
+    header, in buffers of params['write_batch'] lines.
+
+    Input:
+    rows -- iterator of lines
+    path -- a filepath to the output file, compressed if it ends in .gz or .zst
+
+    """
+    params = params or {}
+    buffers = (''.join(batch) for batch in rowwriter.batches(rows, params.get('write_batch', 10000)))
+    rowwriter.write_buffers(buffers, path, MAPS_HEADER, params)
+
+def merge_rows(manual_path, rows, col_name, path=None):
+    """ Generate the rows of the complete pfam_maps table in one pass: the
+    manual mappings followed by the automatic ones, each prefixed with a
+    primary key. This yields the same rows as write_table, append_table and
+    add_pk, without the header line.
+
+    Input:
+    manual_path -- filepath of the manual mappings
+    rows -- iterator of automatic mapping lines as generated by format_rows
+    col_name -- name of the primary key column
+    path -- optional filepath; if given the table, header included, is also written there
+
+    """
+    out = None
+    if path:
+        out = open(path, 'w')
+    infile = tabfile.open_tab(manual_path)
+    try:
+        manual_lines = iter(infile)
+        header = next(manual_lines, '')
+        if header != MAPS_HEADER:
+            raise ValueError('%s: input tables are not same format' % manual_path)
+        if out:
+            out.write('\t'.join([col_name, header]))
+        i = 0
+        for lines in (manual_lines, rows):
+            for line in lines:
+                line = '\t'.join([str(i), line])
+                if out:
+                    out.write(line)
+                yield line
+                i += 1
+    finally:
+        if hasattr(infile, 'close'):
+            infile.close()
+        if out:
+            out.close()
 
 def process_file_headers(inf, out, numline=1):
     ''' Remove file headers. '''
@@ -140,31 +381,314 @@ def process_file_headers(inf, out, numline=1):
     		outfile.write(line)
 
 
-def upload_table(table_name, file_path, create_call, params):
+def upload_table(table_name, file_path, create_call, params, staged=False):
     """
     Load SQL table using connection string defined in global parameters.
     Input:
     params -- dictionary holding details of the connection string.
+    staged -- only load table_name_new, see stage_table
     """
     file_path = os.path.join(os.getcwd(), file_path)
-    process_file_headers(file_path, file_path + '.nohead')
+    # Copy from past the header, so that concurrent batch runs uploading the
+    # same file share no intermediate file.
+    with open(file_path) as infile:
+        infile.readline()
+        return load_table(table_name, infile, create_call, params, staged)
+
+def upload_rows(table_name, lines, create_call, params, staged=False):
+    """
+    Load SQL table from an iterator of header-less lines, without going
+    through a file on disk.
+    Input:
+    params -- dictionary holding details of the connection string.
+    staged -- only load table_name_new, see stage_table
+    """
+    return load_table(table_name, pg2_wrapper.IterFile(lines), create_call, params, staged)
+
+def prefetch(lines, maxsize=8, batch_size=10000):
+    """
+    Iterate over lines in a background thread and hand them over in chunks
+    of batch_size lines through a queue of at most maxsize chunks, so that
+    producing the lines overlaps with consuming them. An exception in the
+    producer, SystemExit and KeyboardInterrupt included, is re-raised in the
+    consumer; the producer stops when the consumer stops.
+    """
+    queue = Queue.Queue(maxsize)
+    done = threading.Event()
+    counters = pg2_wrapper.thread_counters()
+
+    def put(item):
+        while not done.is_set():
+            try:
+                queue.put(item, timeout = 0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def produce():
+        # Queries run by lines count towards the stage of the consumer.
+        pg2_wrapper.share_counters(counters)
+        try:
+            batch = []
+            for line in lines:
+                batch.append(line)
+                if len(batch) >= batch_size:
+                    if not put(''.join(batch)):
+                        return
+                    batch = []
+            if batch and not put(''.join(batch)):
+                return
+            put(None)
+        except BaseException:
+            put(sys.exc_info())
+
+    thread = threading.Thread(target = produce)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item = queue.get()
+            if item is None:
+                break
+            if isinstance(item, tuple):
+                raise item[0], item[1], item[2]
+            yield item
+    finally:
+        done.set()
+        thread.join()
+
+def load_table(table_name, infile, create_call, params, staged=False):
+    """
+    Create table_name, copy the header-less rows of infile into it, then
+    build its indexes and analyze it. If params['swap_tables'] is set, the
+    rows are loaded into a staging table table_name_new, which is then
+    swapped in with swap_tables.
+    Input:
+    infile -- file-like object holding tab-separated rows
+    create_call -- CREATE TABLE statement with a %(table_name)s placeholder
+    params -- dictionary holding details of the connection string.
+    staged -- only load table_name_new and leave the swap to the caller
+    Returns the list of (index, seconds) of the index build.
+    """
+    if staged or params.get('swap_tables'):
+        timings = stage_table(table_name, infile, create_call, params)
+        if not staged:
+            timings += swap_tables([table_name], params).get(table_name, [])
+        return timings
     pg2_wrapper.sql_execute("""DROP TABLE IF EXISTS %s""" % table_name, [], params)
-    pg2_wrapper.sql_execute(create_call, locals(), params)
-    pg2_wrapper.sql_load(file_path + '.nohead', table_name, '\t', params)
+    pg2_wrapper.sql_execute(create_call % {'table_name': table_name}, [], params)
+    pg2_wrapper.sql_copy(infile, table_name, '\t', params)
+    return build_indexes(table_name, table_name, params)
+
+def stage_table(table_name, infile, create_call, params):
+    """
+    Create the staging table table_name_new, copy the header-less rows of
+    infile into it, build its indexes and analyze it. On SQLite, where
+    indexes cannot be renamed, they are built by swap_tables instead.
+    """
+    target = '%s_new' % table_name
+    pg2_wrapper.sql_execute("""DROP TABLE IF EXISTS %s""" % target, [], params)
+    pg2_wrapper.sql_execute(create_call % {'table_name': target}, [], params)
+    pg2_wrapper.sql_copy(infile, target, '\t', params)
+    if pg2_wrapper.is_sqlite(params):
+        pg2_wrapper.sql_execute("""ANALYZE %s""" % target, [], params)
+        return []
+    return build_indexes(table_name, target, params)
+
+def index_name(target, spec):
+    """ Name of an index of INDEXES on the table target. """
+    return '%s_%s' % (target, spec['name'])
+
+def build_indexes(table_name, target, params):
+    """
+    Build the indexes of INDEXES[table_name] on target, then analyze it.
+    Each index is built in its own transaction; on PostgreSQL up to
+    params['index_workers'] parallel maintenance workers are used. Set
+    params['build_indexes'] to False to only analyze.
+    Returns the list of (index, seconds), the last entry being ANALYZE.
+    """
+    timings = []
+    specs = INDEXES.get(table_name, ()) if params.get('build_indexes', True) else ()
+    workers = params.get('index_workers', 0)
+    for spec in specs:
+        name = index_name(target, spec)
+        columns = ', '.join(spec['columns'])
+        if spec.get('primary') and not pg2_wrapper.is_sqlite(params):
+            query = """ALTER TABLE %(target)s ADD CONSTRAINT %(name)s PRIMARY KEY (%(columns)s)""" % locals()
+        else:
+            unique = 'UNIQUE ' if spec.get('primary') else ''
+            query = """CREATE %(unique)sINDEX %(name)s ON %(target)s (%(columns)s)""" % locals()
+            if spec.get('where'):
+                query += """ WHERE %s""" % spec['where']
+        if workers and not pg2_wrapper.is_sqlite(params):
+            query = """SET LOCAL max_parallel_maintenance_workers = %i; %s""" % (workers, query)
+        start = time.time()
+        pg2_wrapper.sql_execute(query, [], params)
+        timings.append((name, round(time.time() - start, 4)))
+    start = time.time()
+    pg2_wrapper.sql_execute("""ANALYZE %s""" % target, [], params)
+    timings.append(('ANALYZE %s' % target, round(time.time() - start, 4)))
+    for (name, seconds) in timings:
+        print "%s: %.2f s" % (name, seconds)
+    return timings
+
+def rename_indexes(table_name, src, dst, params):
+    """
+    Statements moving the indexes of table_name from the names of src to
+    those of dst, for use alongside ALTER TABLE src RENAME TO dst. SQLite
+    cannot rename indexes, so there the indexes named after src are dropped
+    and have to be rebuilt.
+    """
+    if pg2_wrapper.is_sqlite(params):
+        return ["""DROP INDEX IF EXISTS %s""" % index_name(src, spec) for spec in INDEXES.get(table_name, ())]
+    return ["""ALTER INDEX IF EXISTS %s RENAME TO %s""" % (index_name(src, spec), index_name(dst, spec))
+            for spec in INDEXES.get(table_name, ())]
+
+def swap_tables(table_names, params):
+    """
+    Replace each table with its staging table table_name_new, all in one
+    short transaction; indexes are renamed with their tables. The replaced
+    tables are kept as table_name_old so that rollback_table can restore
+    them. On SQLite the indexes are built on the swapped in tables
+    afterwards. Returns a dictionary of the index build timings per table.
+    """
+    queries = []
+    for table_name in table_names:
+        queries.append("""DROP TABLE IF EXISTS %s_old""" % table_name)
+        if table_exists(table_name, params):
+            queries.append("""ALTER TABLE %s RENAME TO %s_old""" % (table_name, table_name))
+            queries.extend(rename_indexes(table_name, table_name, '%s_old' % table_name, params))
+        queries.append("""ALTER TABLE %s_new RENAME TO %s""" % (table_name, table_name))
+        queries.extend(rename_indexes(table_name, '%s_new' % table_name, table_name, params))
+    pg2_wrapper.sql_transaction(queries, params)
+    timings = {}
+    if pg2_wrapper.is_sqlite(params):
+        for table_name in table_names:
+            timings[table_name] = build_indexes(table_name, table_name, params)
+    return timings
+
+def drop_staged(table_names, params):
+    """
+    Drop the staging tables of an upload that failed.
+    """
+    for table_name in table_names:
+        pg2_wrapper.sql_execute("""DROP TABLE IF EXISTS %s_new""" % table_name, [], params)
+    return
+
+def rollback_table(table_name, params):
+    """
+    Restore table_name_old, kept by the last swap_tables, as table_name. The
+    table it replaces is moved back to table_name_new.
+    """
+    pg2_wrapper.sql_transaction(["""DROP TABLE IF EXISTS %s_new""" % table_name,
+                                 """ALTER TABLE %s RENAME TO %s_new""" % (table_name, table_name)] +
+                                rename_indexes(table_name, table_name, '%s_new' % table_name, params) +
+                                ["""ALTER TABLE %s_old RENAME TO %s""" % (table_name, table_name)] +
+                                rename_indexes(table_name, '%s_old' % table_name, table_name, params), params)
+    if pg2_wrapper.is_sqlite(params):
+        build_indexes(table_name, table_name, params)
+    return
+
+def table_exists(table_name, params):
+    """
+    Check whether table_name exists in the database.
+    """
+    if pg2_wrapper.is_sqlite(params):
+        return len(pg2_wrapper.sql_query("""SELECT name FROM sqlite_master WHERE type = 'table' AND name = %s""", [table_name], params)) > 0
+    return pg2_wrapper.sql_query("""SELECT to_regclass(%s)""", [table_name], params)[0][0] is not None
+
+def stage_delta(table_name, lines, create_call, params):
+    """
+    Copy the rows in lines into table_name_delta for apply_delta, without
+    changing table_name.
+    Input:
+    lines -- iterator of header-less lines as produced by merge_rows
+    create_call -- CREATE TABLE statement with a %(table_name)s placeholder
+    params -- dictionary holding details of the connection string.
+    """
+    delta = '%s_delta' % table_name
+    pg2_wrapper.sql_execute("""DROP TABLE IF EXISTS %s""" % delta, [], params)
+    pg2_wrapper.sql_execute(create_call % {'table_name': delta}, [], params)
+    pg2_wrapper.sql_copy(pg2_wrapper.IterFile(lines), delta, '\t', params)
+    pg2_wrapper.sql_transaction(["""CREATE INDEX %s_key ON %s (activity_id, compd_id)""" % (delta, delta),
+                                 """ANALYZE %s""" % delta], params)
     return
 
+def apply_delta(table_name, params):
+    """
+    Apply the difference between table_name_delta, filled by stage_delta,
+    and the current content of table_name, keyed on (activity_id,
+    compd_id). Deletes, updates and inserts are applied in activity_id
+    ranges of params['delta_batch'], one transaction per range. Existing
+    rows keep their map_id, inserted rows are numbered after the current
+    maximum.
+    Input:
+    params -- dictionary holding details of the connection string.
+    Returns a dictionary with the number of inserted, updated and deleted rows.
+    """
+    delta = '%s_delta' % table_name
+    (low, high) = pg2_wrapper.sql_query("""
+        SELECT MIN(activity_id), MAX(activity_id)
+        FROM (SELECT activity_id FROM %(table_name)s
+              UNION ALL
+              SELECT activity_id FROM %(delta)s) AS ids""" % locals(), [], params)[0]
+    counts = {'inserted': 0, 'updated': 0, 'deleted': 0}
+    if low is None:
+        low = high = 0
+    keys = ('activity_id', 'compd_id')
+    cols = [x for x in MAPS_HEADER.rstrip().split('\t') if x not in keys]
+    new_cols = ', '.join(['d.%s' % x for x in cols])
+    old_cols = ', '.join(['t.%s' % x for x in cols])
+    assignments = ', '.join(['%s = d.%s' % (x, x) for x in cols])
+    all_cols = ', '.join(['map_id'] + list(keys) + cols)
+    batch = params.get('delta_batch', 100000)
+    for start in xrange(low, high + 1, batch):
+        stop = start + batch
+        (deleted, updated, inserted) = pg2_wrapper.sql_transaction(["""
+            DELETE FROM %(table_name)s AS t
+            WHERE t.activity_id >= %(start)i AND t.activity_id < %(stop)i
+            AND NOT EXISTS (SELECT 1 FROM %(delta)s d
+                            WHERE d.activity_id = t.activity_id AND d.compd_id = t.compd_id)""" % locals(), """
+            UPDATE %(table_name)s AS t SET %(assignments)s
+            FROM %(delta)s d
+            WHERE d.activity_id = t.activity_id AND d.compd_id = t.compd_id
+            AND t.activity_id >= %(start)i AND t.activity_id < %(stop)i
+            AND (%(old_cols)s) IS DISTINCT FROM (%(new_cols)s)""" % locals(), """
+            INSERT INTO %(table_name)s (%(all_cols)s)
+            SELECT m.top + row_number() OVER (ORDER BY d.map_id), d.activity_id, d.compd_id, %(new_cols)s
+            FROM %(delta)s d
+            CROSS JOIN (SELECT COALESCE(MAX(map_id), -1) AS top FROM %(table_name)s) AS m
+            WHERE d.activity_id >= %(start)i AND d.activity_id < %(stop)i
+            AND NOT EXISTS (SELECT 1 FROM %(table_name)s t
+                            WHERE t.activity_id = d.activity_id AND t.compd_id = d.compd_id)""" % locals()], params)
+        counts['deleted'] += deleted
+        counts['updated'] += updated
+        counts['inserted'] += inserted
+    pg2_wrapper.sql_execute("""DROP TABLE %s""" % delta, [], params)
+    pg2_wrapper.sql_execute("""ANALYZE %s""" % table_name, [], params)
+    return counts
+
 def append_table(tables, outfile):
+    """ Concatenate tables, read through tabfile.open_tab, into outfile
+    under the header of the first. """
     with open(outfile, 'w') as outfile:
-        prev = open(tables[0])
-        prev_header = prev.readline()
-        outfile.write(prev_header)
+        prev_header = None
         for table in tables:
-            with open(table) as infile:
-                header = infile.readline()
+            infile = tabfile.open_tab(table)
+            try:
+                lines = iter(infile)
+                header = next(lines, '')
+                if prev_header is None:
+                    prev_header = header
+                    outfile.write(prev_header)
                 if header != prev_header:
-                    sys.exit('input tables are not same format')
-                for line in infile:
-	            outfile.write(line)
+                    raise ValueError('%s: input tables are not same format' % table)
+                for line in lines:
+                    outfile.write(line)
+            finally:
+                if hasattr(infile, 'close'):
+                    infile.close()
 
 def add_pk(table, col_name):
     outfile = table + '.tmp'
@@ -183,44 +707,13 @@ def add_pk(table, col_name):
     out, err = proc.communicate()
     print out, err
 
-def loader():
-    """
-    Main function to load the mapping of Pfam-A domains.
-    """
-    # Read config file.
-    param_file = open('local.yaml')
-    params = yaml.safe_load(param_file)
-    param_file.close()
-
-    # Load the list of validated domains.
-    domains = readfile('data/valid_pfam_v_%(version)s.tab' % params, 'domain_id', 'domain_id')
-    dom_string = "','".join(domains.keys())
-    domains = tuple(domains.keys())
-
-    # Load a list of manually edited activities.
-    manuals = readfile('data/manual_pfam_maps_v_%(version)s.tab' % params, 'activity_id', 'manual_flag')
-
-    # Get activities for domains.
-    acts  = get_acts(domains, params)
-
-    # Map interactions to activity ids.
-    lkp = map_ints(acts)
+TABLES = ('pfam_maps', 'valid_domains', 'held_domains')
 
-    # Flag conflicts.
-    flag_lkp = flag_conflicts(lkp)
-
-    # Write a table containing activity_id, domain_id, tid, conflict_flag, type_flag
-    write_table(lkp, flag_lkp, manuals, params, 'data/automatic_pfam_maps_v_%(version)s.tab' %params)
-    append_table(['data/manual_pfam_maps_v_%(version)s.tab' %params, 'data/automatic_pfam_maps_v_%(version)s.tab' % params], 'data/pfam_maps_v_%(version)s.tab' %params)
-    add_pk('data/pfam_maps_v_%(version)s.tab' % params, 'map_id')
+CREATE_CALLS = {}
 
-    # Load valid domains table into db.
-    table_name = 'pfam_maps'
-    file_path = 'data/pfam_maps_v_%(version)s.tab' % params
-
-    # The create call can be generated using $> head -n 20 data/automatic_pfam_maps_v_1_3.tab > tmp | csvsql --table pfam_maps tmp 
-    create_call = """
-                  CREATE TABLE pfam_maps (
+# The create call can be generated using $> head -n 20 data/automatic_pfam_maps_v_1_3.tab > tmp | csvsql --table pfam_maps tmp 
+CREATE_CALLS['pfam_maps'] = """
+                  CREATE TABLE %(table_name)s (
                   map_id INTEGER NOT NULL,
                   activity_id INTEGER NOT NULL, 
                   compd_id INTEGER NOT NULL, 
@@ -234,14 +727,10 @@ def loader():
                   domain_id INTEGER NOT NULL
                   )
                   """
-    upload_table(table_name, file_path,  create_call,  params)
-
-    # Load valid domains table into db.
-    table_name = 'valid_domains'
-    file_path = 'data/valid_pfam_v_%(version)s.tab' % params
-    # The create call can be generated using $> head -n 2000 data/valid_pfam_v_1_3.tab > tmp | csvsql --table valid_domains tmp 
-    create_call = """
-                  CREATE TABLE valid_domains (
+
+# The create call can be generated using $> head -n 2000 data/valid_pfam_v_1_3.tab > tmp | csvsql --table valid_domains tmp 
+CREATE_CALLS['valid_domains'] = """
+                  CREATE TABLE %(table_name)s (
                   entry_id INTEGER NOT NULL,
                   domain_name VARCHAR(150) NOT NULL,
                   evidence VARCHAR(250) NOT NULL,
@@ -250,14 +739,10 @@ def loader():
                   domain_id INTEGER NOT NULL
                   )
                   """
-    upload_table(table_name, file_path,  create_call,  params)
-
-    # Load held_domains table into db.
-    table_name = 'held_domains'
-    file_path = 'data/held_pfam_v_%(version)s.tab' % params
-    # The create call can be generated using $> head -n 20 data/automatic_pfam_maps_v_1_3.tab > tmp | csvsql --table pfam_maps tmp
-    create_call = """ 
-                  CREATE TABLE held_domains (
+
+# The create call can be generated using $> head -n 20 data/automatic_pfam_maps_v_1_3.tab > tmp | csvsql --table pfam_maps tmp
+CREATE_CALLS['held_domains'] = """ 
+                  CREATE TABLE %(table_name)s (
                   entry_id INTEGER NOT NULL, 
                   domain_name VARCHAR(150) NOT NULL, 
                   comment VARCHAR(250) NOT NULL, 
@@ -266,11 +751,381 @@ def loader():
                   proposal VARCHAR(450) NOT NULL
                   )
                   """
-    upload_table(table_name, file_path,  create_call,  params)
+
+
+# Indexes built after the rows are copied into a table, see build_indexes.
+INDEXES = {}
+INDEXES['pfam_maps'] = ({'name': 'pkey', 'columns': ('map_id',), 'primary': True},
+                        {'name': 'activity_compd', 'columns': ('activity_id', 'compd_id')},
+                        {'name': 'domain_id', 'columns': ('domain_id',)},
+                        {'name': 'manual', 'columns': ('activity_id',), 'where': 'manual_flag = 1'})
+INDEXES['valid_domains'] = ({'name': 'pkey', 'columns': ('entry_id',), 'primary': True},
+                            {'name': 'domain_id', 'columns': ('domain_id',)})
+INDEXES['held_domains'] = ({'name': 'pkey', 'columns': ('entry_id',), 'primary': True},)
+
+
+# Parameters a stage depends on besides its input files, see checkpoint.py.
+UPLOAD_PARAMS = ('backend', 'sqlite_path', 'host', 'port', 'release', 'swap_tables', 'build_indexes')
+MAPPING_PARAMS = ('backend', 'sqlite_path', 'host', 'port', 'release', 'version', 'classify', 'engine',
+                  'comment', 'timestamp', 'submitter')
+
+
+def upload_stage(report, table_name, file_path, params, staged):
+    """
+    Upload the file at file_path into table_name as an upload stage of report.
+    """
+    with report.stage('upload', table=table_name) as stage:
+        timings = upload_table(table_name, file_path, CREATE_CALLS[table_name], params, staged)
+        stage['bytes'] = os.path.getsize(file_path)
+        stage['indexes'] = [{'index': x[0], 'seconds': x[1]} for x in timings]
+
+def automatic_rows(domains, manuals, params, report, lines=None):
+    """
+    Fetch the activities of the valid domains, map and flag them as set by
+    params['classify'], params['engine'] and params['partitions']. Returns
+    an iterator over the lines of the automatic mapping table.
+    Input:
+    lines -- lines of an earlier classification, eg. by compare_classification, returned instead of fetching again
+    """
+    if lines is not None:
+        return iter(lines)
+    if params.get('classify') == 'server':
+        # Get activities for domains, with flags computed by the server.
+        if params.get('partitions', 1) > 1:
+            # The flags group all domains of an activity, so the query cannot be split by domain.
+            print "warning: partitions is not used with classify: server"
+            report.info.setdefault('warnings', []).append('partitions is not used with classify: server')
+        rows = format_flagged_rows(get_flagged_acts(domains, params), manuals, params)
+    elif params.get('engine') == 'numpy':
+        # Get activities for domains, for chunks of domains concurrently if partitions is set.
+        # Map interactions to activity ids and flag conflicts on arrays.
+        if params.get('partitions', 1) > 1:
+            with report.stage('fetch', partitions=params['partitions']) as stage:
+                columns = get_columns_partitioned(domains, params)
+                stage['rows'] = len(columns[0])
+            with report.stage('map') as stage:
+                maps = array_maps.map_columns(columns)
+                stage['rows'] = len(maps['act_id'])
+            del columns
+        else:
+            with report.stage('map') as stage:
+                maps = array_maps.map_ints(get_acts(domains, params))
+                stage['rows'] = len(maps['act_id'])
+        with report.stage('flag') as stage:
+            flags = array_maps.flag_conflicts(maps)
+            stage['rows'] = len(flags['act_id'])
+        rows = array_maps.format_rows(maps, flags, manuals, params)
+    elif params.get('partitions', 1) > 1:
+        # Get activities for chunks of domains concurrently and map interactions to activity ids.
+        with report.stage('map', partitions=params['partitions']) as stage:
+            lkp = get_acts_partitioned(domains, params)
+            stage['rows'] = len(lkp)
+
+        # Flag conflicts.
+        with report.stage('flag') as stage:
+            flag_lkp = flag_conflicts(lkp)
+            stage['rows'] = len(flag_lkp)
+        rows = format_rows(lkp, flag_lkp, manuals, params)
+    else:
+        # Get activities for domains.
+        acts  = get_acts(domains, params)
+
+        # Map interactions to activity ids.
+        with report.stage('map') as stage:
+            lkp = map_ints(acts)
+            stage['rows'] = len(lkp)
+
+        # Flag conflicts.
+        with report.stage('flag') as stage:
+            flag_lkp = flag_conflicts(lkp)
+            stage['rows'] = len(flag_lkp)
+        rows = format_rows(lkp, flag_lkp, manuals, params)
+    return rows
+
+def skip_stage(report, name, **info):
+    """
+    Record stage name of report as skipped, its checkpoint being current.
+    """
+    with report.stage(name, skipped=True, **info):
+        print "%s: inputs unchanged since the last run, skipped" % name
+
+def read_params(path='local.yaml'):
+    """
+    Read the parameters of a run from the config file.
+    """
+    param_file = open(path)
+    params = yaml.safe_load(param_file)
+    param_file.close()
+    return params
+
+def rollback():
+    """
+    Restore the tables replaced by the last swap_tables load.
+    """
+    params = read_params()
+    checkpoints = checkpoint.Checkpoints(params)
+    for table_name in TABLES:
+        rollback_table(table_name, params)
+        checkpoints.clear('upload_%s' % table_name)
+    pg2_wrapper.close_pools()
+
+def read_inputs(params):
+    """
+    Read the valid domain_ids and the activity_ids of the manual mappings
+    of params['version'].
+    """
+    # Load the list of validated domains.
+    domains = tuple(tabfile.read_keys('data/valid_pfam_v_%(version)s.tab' % params, 'domain_id'))
+
+    # Load a list of manually edited activities.
+    manuals = tabfile.read_keys('data/manual_pfam_maps_v_%(version)s.tab' % params, 'activity_id')
+    return (domains, manuals)
+
+def loader(params=None, inputs=None):
+    """
+    Main function to load the mapping of Pfam-A domains.
+    Input:
+    params -- dictionary of parameters, read from local.yaml if not given
+    inputs -- (domains, manuals) as returned by read_inputs, read if not given
+    Returns the filepath of the run report.
+    """
+    # Read config file.
+    if params is None:
+        params = read_params()
+    report = instrument.Report('loader', params)
+    checkpoints = checkpoint.Checkpoints(params)
+    valid_path = 'data/valid_pfam_v_%(version)s.tab' % params
+    manual_path = 'data/manual_pfam_maps_v_%(version)s.tab' % params
+    output_dir = params.get('output_dir', 'data')
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    with report.stage('read', shared=inputs is not None) as stage:
+        if inputs is None:
+            inputs = read_inputs(params)
+        (domains, manuals) = inputs
+        stage['rows'] = len(domains) + len(manuals)
+
+    compared = None
+    if params.get('classify') == 'compare':
+        # Time the Python against the server-side classification.
+        with report.stage('compare'):
+            (python, server, compared) = compare_classification(domains, manuals, params)
+        report.info['classification'] = {'python': python, 'server': server}
+
+    # Upload the domain tables while pfam_maps is prepared and loaded. All
+    # tables are loaded into staging tables and only swapped in, or the
+    # pfam_maps delta applied, once every upload succeeded. Tables whose upload checkpoint is current are skipped.
+    domain_tables = [('valid_domains', valid_path), ('held_domains', 'data/held_pfam_v_%(version)s.tab' % params)]
+    keys = dict([(table_name, checkpoints.key(params, UPLOAD_PARAMS, [file_path]))
+                 for (table_name, file_path) in domain_tables])
+    for (table_name, file_path) in domain_tables[:]:
+        if checkpoints.done('upload_%s' % table_name, keys[table_name]):
+            skip_stage(report, 'upload', table=table_name)
+            domain_tables.remove((table_name, file_path))
+    concurrent = params.get('concurrent_upload', False)
+    staged = [x[0] for x in domain_tables]
+    if concurrent:
+        pool = ThreadPool(max(len(domain_tables), 1))
+        pending = [pool.apply_async(upload_stage, (report, table_name, file_path, params, True))
+                   for (table_name, file_path) in domain_tables]
+        pool.close()
+
+    incremental = False
+    try:
+        # Load valid domains table into db.
+        table_name = 'pfam_maps'
+        file_path = os.path.join(output_dir, 'pfam_maps_v_%(version)s.tab' % params)
+
+        create_call = CREATE_CALLS[table_name]
+        if params.get('incremental') and table_exists(table_name, params):
+            # Apply only the changes against the mapping already in the database.
+            if not params.get('write_artifact', True):
+                file_path = None
+            checkpoints.clear('upload_%s' % table_name)
+            rows = automatic_rows(domains, manuals, params, report, compared)
+            with report.stage('upload', table=table_name, mode='incremental') as stage:
+                rows = merge_rows(manual_path, rows, 'map_id', file_path)
+                stage_delta(table_name, report.count(rows, stage), create_call, params)
+            incremental = True
+        elif params.get('stream_load'):
+            # Merge, number and upload the rows in a single pass.
+            if not params.get('write_artifact', True):
+                file_path = None
+            checkpoints.clear('upload_%s' % table_name)
+            rows = automatic_rows(domains, manuals, params, report, compared)
+            with report.stage('upload', table=table_name, mode='stream') as stage:
+                rows = report.count(merge_rows(manual_path, rows, 'map_id', file_path), stage)
+                if concurrent:
+                    # Extract and format the rows in another thread while they are copied.
+                    rows = prefetch(rows, params.get('upload_queue', 8), params.get('fetch_size', 10000))
+                    staged.append(table_name)
+                try:
+                    timings = upload_rows(table_name, rows, create_call, params, concurrent)
+                    stage['indexes'] = [{'index': x[0], 'seconds': x[1]} for x in timings]
+                finally:
+                    if concurrent:
+                        rows.close()
+        else:
+            # Write a table containing activity_id, domain_id, tid, conflict_flag, type_flag
+            automatic_path = os.path.join(output_dir, 'automatic_pfam_maps_v_%(version)s.tab' % params)
+            key = checkpoints.key(params, MAPPING_PARAMS, [valid_path, manual_path])
+            if checkpoints.done('write', key):
+                skip_stage(report, 'write')
+            else:
+                rows = automatic_rows(domains, manuals, params, report, compared)
+                with report.stage('write') as stage:
+                    write_rows(report.count(rows, stage), automatic_path, params)
+                checkpoints.mark('write', key, [automatic_path])
+            key = checkpoints.key(params, (), [manual_path, automatic_path])
+            if checkpoints.done('merge', key):
+                skip_stage(report, 'append')
+                skip_stage(report, 'add_pk')
+            else:
+                with report.stage('append') as stage:
+                    append_table([manual_path, automatic_path], file_path)
+                    stage['bytes'] = os.path.getsize(file_path)
+                with report.stage('add_pk') as stage:
+                    add_pk(file_path, 'map_id')
+                    stage['bytes'] = os.path.getsize(file_path)
+                checkpoints.mark('merge', key, [file_path])
+            keys[table_name] = checkpoints.key(params, UPLOAD_PARAMS, [file_path])
+            if checkpoints.done('upload_%s' % table_name, keys[table_name]):
+                skip_stage(report, 'upload', table=table_name)
+            else:
+                if concurrent:
+                    staged.append(table_name)
+                upload_stage(report, table_name, file_path, params, concurrent)
+                if not concurrent:
+                    checkpoints.mark('upload_%s' % table_name, keys[table_name])
+
+        if concurrent:
+            for result in pending:
+                result.get()
+        if incremental:
+            # Change pfam_maps only once every staged upload succeeded.
+            with report.stage('delta', table='pfam_maps') as stage:
+                counts = apply_delta('pfam_maps', params)
+                stage.update(counts)
+            print "pfam_maps delta: ", "inserted %(inserted)i, updated %(updated)i, deleted %(deleted)i" % counts
+    except:
+        if concurrent:
+            # Let running uploads finish before dropping their tables.
+            pool.join()
+            drop_staged(staged, params)
+        if incremental:
+            pg2_wrapper.sql_execute("""DROP TABLE IF EXISTS pfam_maps_delta""", [], params)
+        raise
+
+    if concurrent:
+        pool.join()
+        if staged:
+            with report.stage('swap') as stage:
+                timings = swap_tables(staged, params)
+                stage['indexes'] = [{'index': x[0], 'seconds': x[1]} for name in staged for x in timings.get(name, [])]
+        for table_name in staged:
+            if table_name in keys:
+                checkpoints.mark('upload_%s' % table_name, keys[table_name])
+    else:
+        for (table_name, file_path) in domain_tables:
+            upload_stage(report, table_name, file_path, params, False)
+            checkpoints.mark('upload_%s' % table_name, keys[table_name])
+
+    print "connections opened: %(opened)i, reused: %(reused)i" % pg2_wrapper.stats
+    path = report.write()
+    print "run report: ", path
+    pg2_wrapper.close_pools()
+    return path
+
+# Parsed inputs per version, set by batch before the worker processes are
+# forked so that they inherit them instead of reading the files again.
+_shared_inputs = {}
+
+def load_release(entry):
+    """
+    Run loader for one entry of a batch in a worker process. Returns a
+    summary of the run; errors are caught and reported in the summary.
+    Input:
+    entry -- dictionary of parameters overriding those of local.yaml, holding at least release
+    """
+    params = read_params()
+    params.update(entry)
+    # Keep the table files of concurrent runs apart.
+    params['output_dir'] = os.path.join(params.get('output_dir', 'data'), params['release'])
+    summary = {'release': params['release'], 'version': params['version'], 'report': None, 'error': None}
+    start = time.time()
+    try:
+        summary['report'] = loader(params, _shared_inputs.get(params['version']))
+        summary['status'] = 'ok'
+    except BaseException as err:
+        # SystemExit and KeyboardInterrupt too, so that the pool gets a summary.
+        summary['status'] = 'failed'
+        summary['error'] = '%s: %s' % (type(err).__name__, err)
+    summary['seconds'] = round(time.time() - start, 4)
+    return summary
+
+def batch_entry(entry, params):
+    """
+    Parameters of one batch entry, given as a dictionary or as a string
+    release or release:version. The version defaults to params['version'].
+    """
+    if not isinstance(entry, dict):
+        (release, _, version) = str(entry).partition(':')
+        entry = {'release': release}
+        if version:
+            entry['version'] = version
+    entry = dict(entry)
+    entry.setdefault('version', params['version'])
+    return entry
+
+def batch(entries=None):
+    """
+    Load several releases, running loader for each in a pool of
+    params['batch_workers'] processes. The inputs of each version are read
+    once and shared with the workers. Table files are written to
+    <output_dir>/<release>/. Prints a summary, writes it to report_dir and
+    returns it.
+    Input:
+    entries -- list of batch entries, see batch_entry; defaults to params['batch_releases']
+    """
+    params = read_params()
+    if not entries:
+        entries = params.get('batch_releases') or []
+    entries = [batch_entry(entry, params) for entry in entries]
+    if not entries:
+        sys.exit("No releases given on command line or in batch_releases")
+    started = time.time()
+    for version in sorted(set([entry['version'] for entry in entries])):
+        _shared_inputs[version] = read_inputs(dict(params, version=version))
+    workers = multiprocessing.Pool(min(params.get('batch_workers', 2), len(entries)), maxtasksperchild=1)
+    try:
+        summaries = workers.map(load_release, entries, chunksize=1)
+    finally:
+        workers.close()
+        workers.join()
+    print "release\tversion\tstatus\tseconds\treport"
+    for summary in summaries:
+        print "%(release)s\t%(version)s\t%(status)s\t%(seconds).1f\t%(report)s" % summary
+        if summary['error']:
+            print "    %(error)s" % summary
+    stamp = time.strftime('%Y%m%d_%H%M%S', time.gmtime(started))
+    path = os.path.join(params.get('report_dir', 'data'), 'loader_batch_%s.json' % stamp)
+    with open(path, 'w') as out:
+        json.dump({'started': time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(started)),
+                   'seconds': round(time.time() - started, 4),
+                   'workers': params.get('batch_workers', 2),
+                   'releases': summaries}, out, indent=2, sort_keys=True)
+    print "batch report: ", path
+    return summaries
 
 if __name__ == '__main__':
-    import sys
-    if len(sys.argv) != 1:  
+    if len(sys.argv) == 2 and sys.argv[1] == 'rollback':
+        rollback()
+    elif len(sys.argv) >= 2 and sys.argv[1] == 'batch':
+        summaries = batch(sys.argv[2:])
+        if [x for x in summaries if x['status'] != 'ok']:
+            sys.exit(1)
+    elif len(sys.argv) != 1:
         sys.exit("All parameters are specified in local.yaml or example.yaml")
-
-    loader()
+    else:
+        loader()
@@ -1,40 +1,423 @@
 """
 Function: pgQuery.py
 
-Generic query function.
+Generic query function. Connections are taken from a pool that is shared by
+all functions in this module, one pool per database. The pool size is read
+from params['pool_size']; once that many connections are checked out,
+further callers wait for one to be returned.
+
+With backend: sqlite in params the same functions run against the SQLite
+database at params['sqlite_path'] instead, see chembl_stub.py. Queries are
+written in psycopg2 format style and translated by sqlite_query.
 --------------
 momo.sander@googlemail.com
 """
-import psycopg2
+import contextlib
+import itertools
+import re
+import sqlite3
+import threading
+import time
+from psycopg2 import pool
+
+_cursor_ids = itertools.count()
+_placeholders = re.compile(r'%\((\w+)\)s|%s|%%')
+_any = re.compile(r'=\s*ANY\s*\((%\(\w+\)s|%s)\)', re.IGNORECASE)
+_pools = {}
+stats = {'opened': 0, 'reused': 0, 'query_seconds': 0.0, 'fetch_seconds': 0.0, 'rows_fetched': 0}
+# stats is updated from the worker threads of partitioned and concurrent loads.
+_stats_lock = threading.Lock()
+_local = threading.local()
+
+
+def count(key, value=1):
+    """
+    Add value to stats[key] and to the counters of the current thread.
+    """
+    with _stats_lock:
+        stats[key] += value
+        counters = getattr(_local, 'counters', None)
+        if counters is not None:
+            counters[key] += value
+
+
+def thread_counters():
+    """
+    Counters of the queries run by the current thread, and by the threads
+    that share them, see share_counters.
+    """
+    counters = getattr(_local, 'counters', None)
+    if counters is None:
+        counters = _local.counters = dict([(key, 0) for key in stats])
+    return counters
+
+
+def share_counters(counters):
+    """
+    Add the queries of the current thread to counters, eg. those of the
+    thread it works for.
+    """
+    _local.counters = counters
+
+
+def thread_stats():
+    """
+    Copy of the counters of the current thread.
+    """
+    with _stats_lock:
+        return dict(thread_counters())
+
+
+class CountingPool(pool.ThreadedConnectionPool):
+    """
+    Connection pool that counts the physical connections it opens and keeps
+    up to maxconn of them open for reuse. getconn waits while maxconn
+    connections are checked out instead of raising PoolError.
+    """
+    def __init__(self, minconn, maxconn, *args, **kwargs):
+        pool.ThreadedConnectionPool.__init__(self, minconn, maxconn, *args, **kwargs)
+        self._slots = threading.BoundedSemaphore(maxconn)
+
+    def getconn(self, key=None):
+        self._slots.acquire()
+        try:
+            return pool.ThreadedConnectionPool.getconn(self, key)
+        except:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn=None, key=None, close=False):
+        try:
+            pool.ThreadedConnectionPool.putconn(self, conn, key, close)
+        finally:
+            self._slots.release()
+
+    def _connect(self, key=None):
+        count('opened')
+        _local.opened = True
+        return pool.ThreadedConnectionPool._connect(self, key)
+
+    def _putconn(self, conn, key=None, close=False):
+        # psycopg2 closes returned connections once minconn are idle; raise
+        # the bound to maxconn while putconn holds the pool lock.
+        minconn = self.minconn
+        self.minconn = self.maxconn
+        try:
+            return pool.ThreadedConnectionPool._putconn(self, conn, key, close)
+        finally:
+            self.minconn = minconn
+
+
+def get_pool(params):
+    """
+    Return the connection pool for the database described in params,
+    creating it on first use.
+    """
+    key = (params['host'], params['port'], params['user'], params['release'])
+    try:
+        return _pools[key]
+    except KeyError:
+        _pools[key] = CountingPool(0, params.get('pool_size', 4), host = params['host'], user = params['user'], password = params['pword'], database = params['release'], port = params['port'])
+        return _pools[key]
+
+
+def is_sqlite(params):
+    """
+    Check whether params select the SQLite backend.
+    """
+    return params.get('backend', 'postgres') == 'sqlite'
+
+
+def sqlite_query(query, param):
+    """
+    Translate a query with psycopg2 placeholders (%s, %(name)s) into SQLite
+    qmark style. Tuples and lists are expanded into (?, ?, ...) as psycopg2
+    does for IN clauses; = ANY(array) becomes IN (?, ?, ...). Returns the
+    query and the list of arguments.
+    """
+    if param is None:
+        return (query, [])
+    query = _any.sub(r'IN \1', query)
+    args = []
+    positional = iter(param) if isinstance(param, (list, tuple)) else None
+    def replace(match):
+        if match.group(0) == '%%':
+            return '%'
+        if match.group(1):
+            value = param[match.group(1)]
+        else:
+            value = next(positional)
+        if isinstance(value, (list, tuple)):
+            args.extend(value)
+            return '(%s)' % ', '.join(['?'] * len(value))
+        args.append(value)
+        return '?'
+    return (_placeholders.sub(replace, query), args)
+
+
+def execute(curs, query, param, params):
+    """
+    Execute query on curs, translating it first if params select SQLite.
+    """
+    if is_sqlite(params):
+        curs.execute(*sqlite_query(query, param))
+    else:
+        curs.execute(query, param)
+
+
+@contextlib.contextmanager
+def connection(params):
+    """
+    Check a connection out of the pool. The transaction is committed if the
+    block succeeds and rolled back otherwise; the connection is returned to
+    the pool in both cases. SQLite connections are cheap and not shared
+    between threads, so they are opened per call instead.
+    """
+    if is_sqlite(params):
+        conn = sqlite3.connect(params['sqlite_path'], timeout = params.get('sqlite_timeout', 60))
+        count('opened')
+        try:
+            yield conn
+            conn.commit()
+        except:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        return
+    conn_pool = get_pool(params)
+    # The pool opens connections in the calling thread, see CountingPool.
+    _local.opened = False
+    conn = conn_pool.getconn()
+    if not _local.opened:
+        count('reused')
+    try:
+        yield conn
+        conn.commit()
+    except:
+        if not conn.closed:
+            conn.rollback()
+        raise
+    finally:
+        conn_pool.putconn(conn, close = bool(conn.closed))
+
+
+def close_pools():
+    """
+    Close all pooled connections. Call once at the end of a run.
+    """
+    for conn_pool in _pools.values():
+        conn_pool.closeall()
+    _pools.clear()
+
+
+def reset_stats():
+    """
+    Reset the per-run connection and query counters.
+    """
+    with _stats_lock:
+        stats['opened'] = 0
+        stats['reused'] = 0
+        stats['query_seconds'] = 0.0
+        stats['fetch_seconds'] = 0.0
+        stats['rows_fetched'] = 0
+
 
 def sql_query(query, param, params):
     """
     Processes a query with parameters.
     """
-    conn = psycopg2.connect(host = params['host'], user = params['user'], password = params['pword'], database = params['release'], port = params['port'])
-    curs = conn.cursor()
-    curs.execute(query, param)
-    return curs.fetchall()
+    with connection(params) as conn:
+        curs = conn.cursor()
+        start = time.time()
+        execute(curs, query, param, params)
+        fetched = time.time()
+        data = curs.fetchall()
+        count('query_seconds', fetched - start)
+        count('fetch_seconds', time.time() - fetched)
+        count('rows_fetched', len(data))
+        curs.close()
+    return data
+
+def sql_query_iter(query, param, params, batch_size=None):
+    """
+    Processes a query with parameters on a named (server-side) cursor and
+    yields the rows. At most batch_size rows are held in memory at a time,
+    the default is taken from params['fetch_size']. The time to the first
+    batch is counted as query time, the remaining batches as fetch time.
+    """
+    if batch_size is None:
+        batch_size = params.get('fetch_size', 10000)
+    with connection(params) as conn:
+        if is_sqlite(params):
+            curs = conn.cursor()
+        else:
+            curs = conn.cursor(name = 'pg2_wrapper_%i' % next(_cursor_ids))
+            curs.itersize = batch_size
+        try:
+            start = time.time()
+            execute(curs, query, param, params)
+            key = 'query_seconds'
+            while True:
+                rows = curs.fetchmany(batch_size)
+                count(key, time.time() - start)
+                count('rows_fetched', len(rows))
+                key = 'fetch_seconds'
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+                start = time.time()
+        finally:
+            curs.close()
 
 def sql_execute(query, param, params):
     """
     Processes a query with parameters.
     """
-    conn = psycopg2.connect(host = params['host'], user = params['user'], password = params['pword'], database = params['release'], port = params['port'])
-    curs = conn.cursor()
-    curs.execute(query, param)
-    conn.commit()
-    conn.close()
+    with connection(params) as conn:
+        curs = conn.cursor()
+        execute(curs, query, param, params)
+        curs.close()
     return
 
+def sql_transaction(queries, params):
+    """
+    Processes a list of queries without parameters in one transaction and
+    returns the number of rows affected by each.
+    """
+    rowcounts = []
+    with connection(params) as conn:
+        curs = conn.cursor()
+        for query in queries:
+            execute(curs, query, None, params)
+            rowcounts.append(curs.rowcount)
+        curs.close()
+    return rowcounts
+
 def sql_load(path, table_name, sep, params):
     """
     Processes a query with parameters.
     """
-    f = open(path, 'r')
-    conn = psycopg2.connect(host = params['host'], user = params['user'], password = params['pword'], database = params['release'], port = params['port'])
-    curs = conn.cursor()
-    curs.copy_from(f, table_name, sep)
-    conn.commit()
-    conn.close()
+    with open(path, 'r') as f:
+        sql_copy(f, table_name, sep, params)
     return
+
+def sql_copy(f, table_name, sep, params):
+    """
+    Copy the rows read from a file-like object into table_name.
+    """
+    with connection(params) as conn:
+        if is_sqlite(params):
+            sqlite_copy(conn, f, table_name, sep)
+            return
+        curs = conn.cursor()
+        curs.copy_from(f, table_name, sep)
+        curs.close()
+    return
+
+def sqlite_copy(conn, f, table_name, sep, batch_size=10000):
+    """
+    Emulate copy_from on a SQLite connection: insert the rows read from f in
+    batches. \\N is read as NULL, as in COPY text format.
+    """
+    curs = conn.cursor()
+    insert = None
+    batch = []
+    for line in iter(f.readline, ''):
+        row = [None if x == '\\N' else x for x in line.rstrip('\n').split(sep)]
+        if insert is None:
+            insert = 'INSERT INTO %s VALUES (%s)' % (table_name, ', '.join(['?'] * len(row)))
+        batch.append(row)
+        if len(batch) >= batch_size:
+            curs.executemany(insert, batch)
+            batch = []
+    if batch:
+        curs.executemany(insert, batch)
+    curs.close()
+
+def sql_copy_out(query, f, params):
+    """
+    Write the rows of a query to a file-like object in COPY text format
+    (tab-separated, \\N for NULL) and return the number of rows.
+    """
+    with connection(params) as conn:
+        start = time.time()
+        if is_sqlite(params):
+            rows = sqlite_copy_out(conn, query, f)
+        else:
+            curs = conn.cursor()
+            curs.copy_expert('COPY (%s) TO STDOUT' % query, f)
+            rows = curs.rowcount
+            curs.close()
+        count('query_seconds', time.time() - start)
+        count('rows_fetched', rows)
+    return rows
+
+def copy_text(value):
+    """Format a value as a field of COPY text format."""
+    if value is None:
+        return '\\N'
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    else:
+        value = str(value)
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+def sqlite_copy_out(conn, query, f, batch_size=10000):
+    """
+    Emulate COPY ... TO STDOUT on a SQLite connection.
+    """
+    curs = conn.cursor()
+    curs.execute(query)
+    n = 0
+    while True:
+        rows = curs.fetchmany(batch_size)
+        if not rows:
+            break
+        f.write(''.join(['\t'.join([copy_text(x) for x in row]) + '\n' for row in rows]))
+        n += len(rows)
+    curs.close()
+    return n
+
+
+class IterFile(object):
+    """
+    Read-only file-like object over an iterator of lines, so that copy_from
+    can consume rows as they are generated. Items may also be chunks of
+    several lines.
+    """
+    def __init__(self, lines):
+        self.lines = iter(lines)
+        self.buf = ''
+        self.pos = 0
+
+    def read(self, size=-1):
+        chunks = [self.buf[self.pos:]]
+        n = len(chunks[0])
+        while size < 0 or n < size:
+            try:
+                line = next(self.lines)
+            except StopIteration:
+                break
+            chunks.append(line)
+            n += len(line)
+        data = ''.join(chunks)
+        if size < 0:
+            size = n
+        self.buf = data[size:]
+        self.pos = 0
+        return data[:size]
+
+    def readline(self, size=-1):
+        while self.buf.find('\n', self.pos) < 0:
+            try:
+                chunk = next(self.lines)
+            except StopIteration:
+                break
+            self.buf = self.buf[self.pos:] + chunk
+            self.pos = 0
+        idx = self.buf.find('\n', self.pos) + 1 or len(self.buf)
+        line = self.buf[self.pos:idx]
+        self.pos = idx
+        return line
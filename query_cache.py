@@ -0,0 +1,289 @@
+"""Script:  query_cache.py
+
+On-disk cache for the results of expensive queries against an unchanged
+release (get_acts, get_el_targets, get_doms). Entries are keyed by release,
+database, a hash of the SQL and a hash of the query parameters and stored in
+<cache_dir>/<release>/<backend>_<database hash>/ in a columnar binary
+format: integer and float columns as raw native arrays, string columns
+dictionary-encoded. The database is the SQLite file of sqlite_path or the
+PostgreSQL host and port. Entries are read through mmap, as numpy views into
+the map if numpy is installed. When the cache outgrows cache_size_mb the
+least recently used entries are evicted.
+
+Caching is enabled by setting cache_dir in local.yaml. To invalidate:
+    $> python query_cache.py clear [release]
+
+--------------------
+Author:
+Felix Kruger
+fkrueger@ebi.ac.uk
+"""
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import struct
+import sys
+import tempfile
+from array import array
+from itertools import izip
+import yaml
+import pg2_wrapper
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+MAGIC = 'PFC1'
+
+
+def canonical(value):
+    """Sort sequences, as the result of an IN clause does not depend on
+    their order."""
+    if isinstance(value, (list, tuple)):
+        return sorted(value)
+    return value
+
+
+def source(params):
+    """The database a query runs against: the backend and the SQLite file or
+    the PostgreSQL server."""
+    if pg2_wrapper.is_sqlite(params):
+        return ('sqlite', os.path.abspath(params['sqlite_path']))
+    return ('postgres', params.get('host'), params.get('port'))
+
+
+def cache_key(query, param, params):
+    """Build the key of a query from a hash of the SQL and a hash of the
+    database and the parameters it references.
+
+    Inputs:
+    query -- SQL with psycopg2 placeholders
+    param -- parameters of the query, a dictionary or a sequence
+    params -- dictionary holding backend and sqlite_path or host and port
+
+    """
+    if isinstance(param, dict):
+        names = sorted(set([x for x in pg2_wrapper._placeholders.findall(query) if x]))
+        values = [(name, canonical(param[name])) for name in names]
+    else:
+        values = [canonical(value) for value in param or []]
+    sql_hash = hashlib.sha1(query.encode('utf-8')).hexdigest()
+    param_hash = hashlib.sha1(repr((source(params), values)).encode('utf-8')).hexdigest()
+    return '%s_%s' % (sql_hash[:16], param_hash[:16])
+
+
+def entry_path(query, param, params):
+    """Filepath of the cache entry of a query:
+    <cache_dir>/<release>/<backend>_<database hash>/<key>.col"""
+    database = source(params)
+    directory = '%s_%s' % (database[0], hashlib.sha1(repr(database).encode('utf-8')).hexdigest()[:12])
+    return os.path.join(params['cache_dir'], str(params['release']), directory, '%s.col' % cache_key(query, param, params))
+
+
+class ColumnWriter(object):
+    """
+    Accumulate rows in typed columns. Integer and float columns are held in
+    arrays, string columns as codes into a table of distinct values. Rows
+    with values of another type mark the result as not cacheable.
+    """
+    def __init__(self):
+        self.columns = None
+        self.rows = 0
+        self.ok = True
+
+    def _column(self, value):
+        if isinstance(value, bool):
+            return None
+        if isinstance(value, (int, long)):
+            return {'type': 'l', 'data': array('l')}
+        if isinstance(value, float):
+            return {'type': 'd', 'data': array('d')}
+        if isinstance(value, basestring):
+            return {'type': 's', 'data': array('i'), 'strings': [], 'codes': {}, 'unicode': isinstance(value, unicode)}
+        return None
+
+    def append(self, row):
+        if not self.ok:
+            return
+        if self.columns is None:
+            self.columns = [self._column(value) for value in row]
+            if None in self.columns:
+                self.ok = False
+                return
+        try:
+            for (column, value) in zip(self.columns, row):
+                if column['type'] == 's':
+                    if not isinstance(value, basestring):
+                        raise TypeError(value)
+                    try:
+                        code = column['codes'][value]
+                    except KeyError:
+                        code = column['codes'][value] = len(column['strings'])
+                        column['strings'].append(value)
+                    column['data'].append(code)
+                else:
+                    column['data'].append(value)
+        except (TypeError, OverflowError):
+            self.ok = False
+            self.columns = None
+            return
+        self.rows += 1
+
+    def write(self, path):
+        """Write the columns to path, via a temporary file in the same directory."""
+        columns = self.columns or []
+        header = {'rows': self.rows, 'columns': []}
+        offset = 0
+        for column in columns:
+            nbytes = len(column['data']) * column['data'].itemsize
+            entry = {'type': column['type'], 'offset': offset, 'nbytes': nbytes}
+            if column['type'] == 's':
+                entry['unicode'] = column['unicode']
+                entry['strings'] = [x if column['unicode'] else x.decode('utf-8') for x in column['strings']]
+            header['columns'].append(entry)
+            offset += nbytes
+        header = json.dumps(header).encode('utf-8')
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        (fd, tmp_path) = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'wb') as out:
+            out.write(MAGIC)
+            out.write(struct.pack('<I', len(header)))
+            out.write(header)
+            for column in columns:
+                column['data'].tofile(out)
+        os.rename(tmp_path, path)
+
+
+def read_entry(path, size=10000):
+    """Read a cache entry through mmap. Returns an iterator over its rows,
+    converted size rows at a time. With numpy the columns are read as views
+    into the map; the map is closed once the rows are exhausted."""
+    with open(path, 'rb') as infile:
+        if os.fstat(infile.fileno()).st_size == 0:
+            return iter([])
+        data = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if data[:4] != MAGIC:
+            raise IOError('not a query cache entry: %s' % path)
+        (length,) = struct.unpack('<I', data[4:8])
+        header = json.loads(data[8:8 + length].decode('utf-8'))
+    except:
+        data.close()
+        raise
+    return iter_rows(data, 8 + length, header, size)
+
+
+def iter_rows(data, start, header, size):
+    """Generate the rows of the columns in data, an open mmap, and close it
+    at the end."""
+    try:
+        columns = []
+        for entry in header['columns']:
+            typecode = 'i' if entry['type'] == 's' else entry['type']
+            if np is not None:
+                column = np.frombuffer(data, dtype=np.dtype(typecode), count=header['rows'], offset=start + entry['offset'])
+            else:
+                column = (start + entry['offset'], typecode)
+            if entry['type'] == 's':
+                strings = entry['strings']
+                if not entry['unicode']:
+                    strings = [x.encode('utf-8') for x in strings]
+                columns.append((column, strings))
+            else:
+                columns.append((column, None))
+        for i in xrange(0, header['rows'] if columns else 0, size):
+            n = min(size, header['rows'] - i)
+            batch = []
+            for (column, strings) in columns:
+                if np is not None:
+                    values = column[i:i + n].tolist()
+                else:
+                    values = array(column[1])
+                    itemsize = values.itemsize
+                    values.fromstring(data[column[0] + i * itemsize:column[0] + (i + n) * itemsize])
+                if strings is not None:
+                    values = map(strings.__getitem__, values)
+                batch.append(values)
+            for row in izip(*batch):
+                yield row
+    finally:
+        # The views must not outlive the map.
+        del columns
+        data.close()
+
+
+def evict(params):
+    """Remove the least recently used entries until the cache fits into
+    params['cache_size_mb'].
+    """
+    limit = params.get('cache_size_mb', 1024) * 1024 * 1024
+    entries = []
+    for root, dirs, files in os.walk(params['cache_dir']):
+        for name in files:
+            if name.endswith('.col'):
+                path = os.path.join(root, name)
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum([x[1] for x in entries])
+    for (mtime, size, path) in sorted(entries):
+        if total <= limit:
+            break
+        os.remove(path)
+        total -= size
+
+
+def store(rows, path, params):
+    """Pass rows through and write them to the cache entry at path once
+    they are exhausted.
+    """
+    writer = ColumnWriter()
+    for row in rows:
+        writer.append(row)
+        yield row
+    if writer.ok:
+        writer.write(path)
+        evict(params)
+
+
+def sql_query_iter(query, param, params):
+    """
+    Cached counterpart of pg2_wrapper.sql_query_iter. Without cache_dir in
+    params the query goes straight to the database.
+    """
+    if not params.get('cache_dir'):
+        return pg2_wrapper.sql_query_iter(query, param, params)
+    path = entry_path(query, param, params)
+    if os.path.exists(path):
+        os.utime(path, None)
+        return read_entry(path)
+    return store(pg2_wrapper.sql_query_iter(query, param, params), path, params)
+
+
+def sql_query(query, param, params):
+    """
+    Cached counterpart of pg2_wrapper.sql_query.
+    """
+    return list(sql_query_iter(query, param, params)) if params.get('cache_dir') else pg2_wrapper.sql_query(query, param, params)
+
+
+def invalidate(params, release=None):
+    """Remove all cache entries, or those of one release."""
+    path = params['cache_dir']
+    if release is not None:
+        path = os.path.join(path, str(release))
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (2, 3) or sys.argv[1] != 'clear':
+        sys.exit("Usage: python query_cache.py clear [release], cache_dir is read from local.yaml")
+    param_file = open('local.yaml')
+    params = yaml.safe_load(param_file)
+    param_file.close()
+    invalidate(params, sys.argv[2] if len(sys.argv) == 3 else None)
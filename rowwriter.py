@@ -0,0 +1,173 @@
+"""Script:  rowwriter.py
+
+Batched writer for the mapping tables of loader.py and exporter.py. Rows are
+formatted with one positional template per table and joined into buffers of
+params['write_batch'] rows, so that each buffer is written with a single call.
+The lines are those of the per-row formatting they replace. Output paths
+ending in .gz are gzip-compressed, those ending in .zst zstd-compressed (this
+needs the zstandard package); with params['compress_threads'] > 1 the
+compression runs in that many threads. Multi-threaded gzip output consists
+of one gzip member per block, which gzip, zcat and tabfile read as one file;
+tabfile.open_tab reads the .zst files too.
+
+--------------------
+Author:
+Felix Kruger
+fkrueger@ebi.ac.uk
+"""
+import collections
+import gzip
+from cStringIO import StringIO
+from itertools import islice
+from multiprocessing.pool import ThreadPool
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+MAPS_HEADER = """activity_id\tcompd_id\tdomain_name\tcategory_flag\tstatus_flag\tmanual_flag\tcomment\ttimestamp\tsubmitter\tdomain_id\n"""
+# One line of the mapping table, from the values in the order of MAPS_HEADER.
+MAPS_LINE = """%i\t%i\t%s\t%i\t%i\t%i\t%s\t%s\t%s\t%s\n"""
+
+
+def bind(template, values):
+    """Return template with some of its fields filled in, taking the others
+    positionally.
+
+    Inputs:
+    template -- tab-separated format string with one conversion per field, eg. MAPS_LINE
+    values -- dictionary of field position to value
+
+    """
+    fields = template.split('\t')
+    for (i, value) in values.items():
+        fields[i] = ('%s' % value).replace('%', '%%') + ('\n' if fields[i].endswith('\n') else '')
+    return '\t'.join(fields)
+
+
+def batches(items, size=10000):
+    """Generate lists of up to size consecutive items."""
+    items = iter(items)
+    while True:
+        batch = list(islice(items, size))
+        if not batch:
+            return
+        yield batch
+
+
+def format_rows(rows, template=MAPS_LINE, size=10000):
+    """Generate buffers of size lines, each row formatted with template.
+
+    Inputs:
+    rows -- iterable of tuples of the values of one line
+    template -- format string of one line taking the values positionally
+
+    """
+    for batch in batches(rows, size):
+        yield ''.join([template % row for row in batch])
+
+
+def gzip_member(data, level):
+    """Compress data into a complete gzip member."""
+    buf = StringIO()
+    member = gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=level, mtime=0)
+    member.write(data)
+    member.close()
+    return buf.getvalue()
+
+
+class GzipWriter(object):
+    """
+    Write a gzip file, compressing blocks of block_size bytes as separate
+    members in a pool of threads. Members are written in order.
+    """
+    def __init__(self, path, threads, level=6, block_size=1 << 22):
+        self.out = open(path, 'wb')
+        self.pool = ThreadPool(threads)
+        self.threads = threads
+        self.level = level
+        self.block_size = block_size
+        self.pending = collections.deque()
+        self.buf = []
+        self.size = 0
+
+    def write(self, data):
+        self.buf.append(data)
+        self.size += len(data)
+        if self.size >= self.block_size:
+            self.submit()
+
+    def submit(self):
+        self.pending.append(self.pool.apply_async(gzip_member, (''.join(self.buf), self.level)))
+        self.buf = []
+        self.size = 0
+        # Bound the blocks held in memory.
+        while len(self.pending) > 2 * self.threads:
+            self.out.write(self.pending.popleft().get())
+
+    def close(self):
+        try:
+            if self.buf:
+                self.submit()
+            while self.pending:
+                self.out.write(self.pending.popleft().get())
+        finally:
+            self.pool.close()
+            self.pool.join()
+            self.out.close()
+
+
+class ZstdWriter(object):
+    """
+    Write a zstd file, compressed in threads worker threads of the zstd
+    library if threads > 1.
+    """
+    def __init__(self, path, threads, level=3):
+        if zstandard is None:
+            raise ImportError('.zst output requires the zstandard package')
+        self.compressor = zstandard.ZstdCompressor(level=level, threads=threads if threads > 1 else 0).compressobj()
+        self.out = open(path, 'wb')
+
+    def write(self, data):
+        self.out.write(self.compressor.compress(data))
+
+    def close(self):
+        try:
+            self.out.write(self.compressor.flush())
+        finally:
+            self.out.close()
+
+
+def open_output(path, threads=1):
+    """Open path for writing, gzip-compressed if it ends in .gz and
+    zstd-compressed if it ends in .zst, in threads threads."""
+    if path.endswith('.zst'):
+        return ZstdWriter(path, threads)
+    if path.endswith('.gz'):
+        if threads > 1:
+            return GzipWriter(path, threads)
+        return gzip.open(path, 'wb')
+    return open(path, 'w')
+
+
+def write_buffers(buffers, path, header, params):
+    """Write header and the buffers of format_rows, or any iterable of
+    strings, to path. Returns the number of uncompressed bytes written.
+
+    Inputs:
+    buffers -- iterable of strings
+    path -- a filepath to the output file, compressed if it ends in .gz or .zst
+    params -- dictionary holding compress_threads
+
+    """
+    out = open_output(path, params.get('compress_threads', 1))
+    try:
+        out.write(header)
+        n = len(header)
+        for buf in buffers:
+            out.write(buf)
+            n += len(buf)
+    finally:
+        out.close()
+    return n
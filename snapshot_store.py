@@ -0,0 +1,391 @@
+"""Script:  snapshot_store.py
+
+Versioned store for the data/*_v_<version>.tab files. For each kind of file
+(manual_pfam_maps, valid_pfam, held_pfam) the store keeps the first version
+added as a base snapshot and every later version as a delta against the
+one before, in data/store/<kind>/. A version whose columns differ from the
+one before starts a new base snapshot. Snapshots and deltas are sorted by the
+key of the kind, (activity_id, compd_id) for the manual mappings and
+entry_id otherwise, and gzip-compressed. A version is rebuilt by merging
+the base with its deltas in one streaming pass, in key order. The line order
+of the file a version was added from, blank lines included, is kept in
+order_v_<version>.gz unless it is the key order, so reading a version back
+gives the bytes of that file. Files are replaced through a temporary file,
+and the manifest is written last.
+
+tabfile reads a data/<kind>_v_<version>.tab path from the store when the
+file itself is missing. eg.:
+    $> python snapshot_store.py add data/manual_pfam_maps_v_1_2.tab data/manual_pfam_maps_v_1_3.tab
+    $> python snapshot_store.py checkout data/manual_pfam_maps_v_1_3.tab
+    $> python snapshot_store.py diff manual_pfam_maps 1_2 1_3
+    $> python snapshot_store.py log manual_pfam_maps 1_2 1_3
+
+--------------------
+Author:
+Felix Kruger
+fkrueger@ebi.ac.uk
+"""
+import gzip
+import itertools
+import json
+import os
+import re
+import sys
+
+
+KEYS = {'manual_pfam_maps': ('activity_id', 'compd_id'),
+        'valid_pfam': ('entry_id',),
+        'held_pfam': ('entry_id',)}
+_name = re.compile(r'^(\w+?)_v_(\w+)\.tab$')
+
+
+def split_path(path):
+    """Split data/<kind>_v_<version>.tab into the store directory, kind and version."""
+    match = _name.match(os.path.basename(path))
+    if match is None or match.group(1) not in KEYS:
+        raise ValueError('not a versioned data file: %s' % path)
+    return (os.path.join(os.path.dirname(path), 'store'), match.group(1), match.group(2))
+
+
+def read_manifest(store_dir, kind):
+    """Return the manifest of kind: key columns, versions in order and the
+    header of each version stored as a base snapshot."""
+    path = os.path.join(store_dir, kind, 'manifest.json')
+    if not os.path.exists(path):
+        return {'key': list(KEYS[kind]), 'versions': [], 'bases': {}}
+    with open(path) as infile:
+        return json.load(infile)
+
+
+def write_manifest(store_dir, kind, manifest):
+    path = os.path.join(store_dir, kind, 'manifest.json')
+    with open(path + '.tmp', 'w') as out:
+        json.dump(manifest, out, indent=2)
+    os.rename(path + '.tmp', path)
+
+
+def key_func(header, key_names):
+    """Return a function extracting the integer key of a line."""
+    columns = header.rstrip('\r\n').split('\t')
+    indices = [columns.index(name) for name in key_names]
+    def key(line):
+        elements = line.split('\t')
+        return tuple([int(elements[i]) for i in indices])
+    return key
+
+
+def read_sorted(path, key_names, infile=None):
+    """Read a tab-separated file. Returns its header, its lines sorted by
+    key, the order of the file and whether it ends in a newline. The order
+    is None if the file is in key order, otherwise it has an entry per line
+    after the header: the position of the line among the sorted lines, or
+    the line itself if it is blank. Raises ValueError on repeated keys.
+    The lines are read from infile if given, eg. a compressed file opened
+    with tabfile.open_tab, and from path otherwise."""
+    if infile is None:
+        with open(path, 'r') as infile:
+            return read_sorted(path, key_names, infile)
+    infile = iter(infile)
+    header = next(infile, '')
+    last = header
+    lines = []
+    order = []
+    for line in infile:
+        last = line
+        if line.strip():
+            order.append(len(lines))
+            lines.append(line if line.endswith('\n') else line + '\n')
+        else:
+            order.append(line)
+    key = key_func(header, key_names)
+    ranks = sorted(range(len(lines)), key=lambda i: key(lines[i]))
+    position = [0] * len(lines)
+    for (i, j) in enumerate(ranks):
+        position[j] = i
+    lines = [lines[j] for j in ranks]
+    for i in range(1, len(lines)):
+        if key(lines[i]) == key(lines[i - 1]):
+            raise ValueError('%s: key %s occurs more than once' % (path, key(lines[i])))
+    order = [position[x] if isinstance(x, int) else x for x in order]
+    if order == range(len(lines)):
+        order = None
+    return (header, lines, order, not last or last.endswith('\n'))
+
+
+def diff_lines(old, new, key, new_key=None):
+    """Merge two key-sorted iterators of lines. Generates (op, old_line,
+    new_line) with op '+' for inserted, '-' for deleted and '=' for changed
+    keys; unchanged lines are skipped. new_key defaults to key."""
+    new_key = new_key or key
+    old = iter(old)
+    new = iter(new)
+    a = next(old, None)
+    b = next(new, None)
+    while a is not None or b is not None:
+        if b is None or (a is not None and key(a) < new_key(b)):
+            yield ('-', a, None)
+            a = next(old, None)
+        elif a is None or new_key(b) < key(a):
+            yield ('+', None, b)
+            b = next(new, None)
+        else:
+            if a != b:
+                yield ('=', a, b)
+            a = next(old, None)
+            b = next(new, None)
+
+
+def apply_delta(lines, delta, key):
+    """Merge a key-sorted iterator of lines with a key-sorted iterator of
+    (op, line) delta entries. Generates the lines of the next version."""
+    delta = iter(delta)
+    d = next(delta, None)
+    for line in lines:
+        k = key(line)
+        while d is not None and key(d[1]) < k:
+            if d[0] != '+':
+                raise ValueError('delta %s of a missing key %s' % (d[0], key(d[1])))
+            yield d[1]
+            d = next(delta, None)
+        if d is not None and key(d[1]) == k:
+            if d[0] == '=':
+                yield d[1]
+            elif d[0] != '-':
+                raise ValueError('delta + of an existing key %s' % (k,))
+            d = next(delta, None)
+        else:
+            yield line
+    while d is not None:
+        if d[0] != '+':
+            raise ValueError('delta %s of a missing key %s' % (d[0], key(d[1])))
+        yield d[1]
+        d = next(delta, None)
+
+
+def read_delta(path):
+    """Generate the (op, line) entries of a delta file."""
+    infile = gzip.open(path, 'rb')
+    try:
+        for line in infile:
+            yield (line[0], line[2:])
+    finally:
+        infile.close()
+
+
+def read_base(path):
+    """Generate the lines of a base snapshot, without header."""
+    infile = gzip.open(path, 'rb')
+    try:
+        infile.readline()
+        for line in infile:
+            yield line
+    finally:
+        infile.close()
+
+
+def read_order(path):
+    """Generate the entries of an order file: positions among the sorted
+    lines, or blank lines."""
+    infile = gzip.open(path, 'rb')
+    try:
+        for line in infile:
+            yield line[1:] if line.startswith('#') else int(line)
+    finally:
+        infile.close()
+
+
+def write_gzip(path, lines):
+    """Write lines to the gzip file at path through a temporary file renamed
+    over it. Returns the number of lines."""
+    n = 0
+    out = gzip.open(path + '.tmp', 'wb')
+    try:
+        for line in lines:
+            out.write(line)
+            n += 1
+    except:
+        out.close()
+        os.remove(path + '.tmp')
+        raise
+    out.close()
+    os.rename(path + '.tmp', path)
+    return n
+
+
+def chain(manifest, version):
+    """Return the versions to merge to rebuild version: its base snapshot
+    followed by the deltas up to version."""
+    versions = manifest['versions'][:manifest['versions'].index(version) + 1]
+    start = max([i for (i, v) in enumerate(versions) if v in manifest['bases']])
+    return versions[start:]
+
+
+def header(store_dir, kind, version):
+    """Return the header line of version."""
+    manifest = read_manifest(store_dir, kind)
+    return str(manifest['bases'][chain(manifest, version)[0]])
+
+
+def iter_version(store_dir, kind, version):
+    """Generate the header and the lines of version, sorted by key."""
+    manifest = read_manifest(store_dir, kind)
+    if version not in manifest['versions']:
+        raise IOError('version %s of %s is not in %s' % (version, kind, store_dir))
+    versions = chain(manifest, version)
+    head = str(manifest['bases'][versions[0]])
+    key = key_func(head, manifest['key'])
+    lines = read_base(os.path.join(store_dir, kind, 'base_v_%s.tab.gz' % versions[0]))
+    for v in versions[1:]:
+        lines = apply_delta(lines, read_delta(os.path.join(store_dir, kind, 'delta_v_%s.tab.gz' % v)), key)
+    yield head
+    for line in lines:
+        yield line
+
+
+def iter_file(store_dir, kind, version):
+    """Generate the lines of version in the order of the file it was added
+    from, header first."""
+    manifest = read_manifest(store_dir, kind)
+    lines = iter_version(store_dir, kind, version)
+    if version in manifest.get('orders', []):
+        head = next(lines)
+        by_key = list(lines)
+        order = read_order(os.path.join(store_dir, kind, 'order_v_%s.gz' % version))
+        lines = itertools.chain([head], (x if isinstance(x, str) else by_key[x] for x in order))
+    if version not in manifest.get('no_newline', []):
+        return lines
+    return strip_newline(lines)
+
+
+def strip_newline(lines):
+    """Pass lines through, without the newline of the last one."""
+    prev = None
+    for line in lines:
+        if prev is not None:
+            yield prev
+        prev = line
+    if prev is not None:
+        yield prev[:-1] if prev.endswith('\n') else prev
+
+
+def open_path(path):
+    """Generate the lines, header first, of data/<kind>_v_<version>.tab from the store."""
+    (store_dir, kind, version) = split_path(path)
+    return iter_file(store_dir, kind, version)
+
+
+def add(path, infile=None):
+    """Add the file at path as the next version of its kind. The first
+    version becomes the base snapshot, later ones are stored as the delta
+    against the latest version in the store, unless its columns differ.
+    Adding the latest version again replaces it. Returns the number of lines in the snapshot or delta.
+    The lines are read from infile if given, see read_sorted."""
+    (store_dir, kind, version) = split_path(path)
+    manifest = read_manifest(store_dir, kind)
+    directory = os.path.join(store_dir, kind)
+    replaced = []
+    if version in manifest['versions']:
+        if version != manifest['versions'][-1]:
+            raise ValueError('version %s of %s is already in %s' % (version, kind, store_dir))
+        # Replace the latest version, eg. when a curation round is exported again.
+        # Its files are removed once the new ones and the manifest are written.
+        manifest['versions'].pop()
+        if manifest['bases'].pop(version, None) is None:
+            replaced.append('delta_v_%s.tab.gz' % version)
+        else:
+            replaced.append('base_v_%s.tab.gz' % version)
+        if version in manifest.get('orders', []):
+            manifest['orders'].remove(version)
+            replaced.append('order_v_%s.gz' % version)
+        if version in manifest.get('no_newline', []):
+            manifest['no_newline'].remove(version)
+    (head, lines, order, newline) = read_sorted(path, manifest['key'], infile)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    if not manifest['versions'] or head != header(store_dir, kind, manifest['versions'][-1]):
+        manifest['bases'][version] = head
+        name = 'base_v_%s.tab.gz' % version
+        write_gzip(os.path.join(directory, name), itertools.chain([head], lines))
+        n = len(lines)
+    else:
+        key = key_func(head, manifest['key'])
+        previous = iter_version(store_dir, kind, manifest['versions'][-1])
+        next(previous)
+        name = 'delta_v_%s.tab.gz' % version
+        n = write_gzip(os.path.join(directory, name),
+                       ('%s\t%s' % (op, new if new is not None else old) for (op, old, new) in diff_lines(previous, lines, key)))
+    written = [name]
+    if order is not None:
+        written.append('order_v_%s.gz' % version)
+        write_gzip(os.path.join(directory, written[-1]), ['%i\n' % x if isinstance(x, int) else '#' + x for x in order])
+        manifest.setdefault('orders', []).append(version)
+    if not newline:
+        manifest.setdefault('no_newline', []).append(version)
+    manifest['versions'].append(version)
+    write_manifest(store_dir, kind, manifest)
+    for name in replaced:
+        if name not in written:
+            os.remove(os.path.join(directory, name))
+    return n
+
+
+def checkout(path):
+    """Write data/<kind>_v_<version>.tab from the store."""
+    with open(path + '.tmp', 'w') as out:
+        out.writelines(open_path(path))
+    os.rename(path + '.tmp', path)
+
+
+def diff(store_dir, kind, old_version, new_version):
+    """Generate (op, old_line, new_line) between two versions, see
+    diff_lines. Versions with different columns differ in every line."""
+    manifest = read_manifest(store_dir, kind)
+    old = iter_version(store_dir, kind, old_version)
+    new = iter_version(store_dir, kind, new_version)
+    old_key = key_func(next(old), manifest['key'])
+    new_key = key_func(next(new), manifest['key'])
+    return diff_lines(old, new, old_key, new_key)
+
+
+def changelog(store_dir, kind, old_version, new_version):
+    """Count inserted, deleted and changed lines between two versions, and
+    the number of changes per column."""
+    old_columns = header(store_dir, kind, old_version).rstrip('\r\n').split('\t')
+    new_columns = header(store_dir, kind, new_version).rstrip('\r\n').split('\t')
+    log = {'+': 0, '-': 0, '=': 0, 'columns': dict([(x, 0) for x in set(old_columns + new_columns)])}
+    for (op, old, new) in diff(store_dir, kind, old_version, new_version):
+        log[op] += 1
+        if op == '=':
+            a = dict(zip(old_columns, old.rstrip('\n').split('\t')))
+            b = dict(zip(new_columns, new.rstrip('\n').split('\t')))
+            for name in log['columns'].keys():
+                if a.get(name) != b.get(name):
+                    log['columns'][name] += 1
+    return log
+
+
+if __name__ == '__main__':
+    usage = """Usage: python snapshot_store.py add <path> [path ...]
+       python snapshot_store.py checkout <path> [path ...]
+       python snapshot_store.py diff <kind> <old_version> <new_version>
+       python snapshot_store.py log <kind> <old_version> <new_version>"""
+    if len(sys.argv) >= 3 and sys.argv[1] == 'add':
+        for path in sys.argv[2:]:
+            print path, add(path)
+    elif len(sys.argv) >= 3 and sys.argv[1] == 'checkout':
+        for path in sys.argv[2:]:
+            checkout(path)
+    elif len(sys.argv) == 5 and sys.argv[1] == 'diff':
+        for (op, old, new) in diff('data/store', sys.argv[2], sys.argv[3], sys.argv[4]):
+            if op == '=':
+                sys.stdout.write('-\t%s+\t%s' % (old, new))
+            else:
+                sys.stdout.write('%s\t%s' % (op, new if new is not None else old))
+    elif len(sys.argv) == 5 and sys.argv[1] == 'log':
+        log = changelog('data/store', sys.argv[2], sys.argv[3], sys.argv[4])
+        print "inserted %i, deleted %i, changed %i" % (log['+'], log['-'], log['='])
+        for name in sorted(log['columns'].keys()):
+            if log['columns'][name]:
+                print "%s\t%i" % (name, log['columns'][name])
+    else:
+        sys.exit(usage)
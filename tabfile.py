@@ -0,0 +1,154 @@
+"""Script:  tabfile.py
+
+Reader for the tab-separated data/*.tab files shared by loader.py,
+coverage.py and chembl_stub.py. Files are streamed line by line, gzip if the
+path ends in .gz and zstd if it ends in .zst (this needs the zstandard
+package), also when the compressed file is the newest of the plain file and
+its compressed forms. The header is checked for the requested columns and every
+row for its number of fields. Values are converted with the given types, so
+ids come back as integers. Malformed rows raise TabFormatError naming the
+file and line. Versioned files missing from data/ are read from the
+snapshot store, see snapshot_store.py.
+
+--------------------
+Author:
+Felix Kruger
+fkrueger@ebi.ac.uk
+"""
+import gzip
+import os
+import snapshot_store
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class TabFormatError(ValueError):
+    """A missing column or a malformed row in a tab-separated file."""
+    def __init__(self, path, line_no, message):
+        ValueError.__init__(self, '%s:%i: %s' % (path, line_no, message))
+        self.path = path
+        self.line_no = line_no
+
+
+class ZstdLines(object):
+    """
+    Iterate over the lines of a zstd-compressed file, as written by
+    rowwriter.ZstdWriter.
+    """
+    def __init__(self, path, size=1 << 20):
+        if zstandard is None:
+            raise ImportError('reading .zst files requires the zstandard package')
+        self.infile = open(path, 'rb')
+        self.reader = zstandard.ZstdDecompressor().stream_reader(self.infile)
+        self.size = size
+
+    def __iter__(self):
+        tail = ''
+        while True:
+            chunk = self.reader.read(self.size)
+            if not chunk:
+                break
+            lines = (tail + chunk).split('\n')
+            tail = lines.pop()
+            for line in lines:
+                yield line + '\n'
+        if tail:
+            yield tail
+
+    def close(self):
+        self.reader.close()
+        self.infile.close()
+
+
+def resolve(path):
+    """Return the file to read for path: the most recently modified of path,
+    path.gz and path.zst, as written by exporter.py with export_compression,
+    or path if none exists."""
+    if path.endswith(('.gz', '.zst')):
+        return path
+    candidates = [x for x in (path, path + '.gz', path + '.zst') if os.path.exists(x)]
+    if not candidates:
+        return path
+    return max(candidates, key=os.path.getmtime)
+
+
+def open_tab(path):
+    """Open a tab-separated file for reading, decompressed if path ends in
+    .gz or .zst or the compressed file is the one resolved. A missing
+    data/<kind>_v_<version>.tab file is read from the snapshot store, as an
+    iterator of lines."""
+    path = resolve(path)
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    if path.endswith('.zst'):
+        return ZstdLines(path)
+    if not os.path.exists(path):
+        try:
+            return snapshot_store.open_path(path)
+        except ValueError:
+            pass
+    return open(path, 'r')
+
+
+def column_indices(path, header, names):
+    """Return the positions of names in the header, raise TabFormatError if one is missing."""
+    indices = []
+    for name in names:
+        try:
+            indices.append(header.index(name))
+        except ValueError:
+            raise TabFormatError(path, 1, 'missing column %s, found %s' % (name, ', '.join(header)))
+    return indices
+
+
+def iter_rows(path, names, types=None):
+    """Generate tuples of the requested columns, converted with types.
+
+    Inputs:
+    path -- filepath
+    names -- names of the columns to return
+    types -- dictionary of column name to type, eg. {'activity_id': int}; other columns are str
+
+    """
+    types = types or {}
+    infile = open_tab(path)
+    lines = iter(infile)
+    try:
+        header = next(lines, '').rstrip('\r\n').split('\t')
+        indices = column_indices(path, header, names)
+        convert = [types.get(name, str) for name in names]
+        n_tabs = len(header) - 1
+        for (line_no, line) in enumerate(lines, 2):
+            line = line.rstrip('\r\n')
+            if not line:
+                continue
+            if line.count('\t') != n_tabs:
+                raise TabFormatError(path, line_no, 'expected %i fields, found %i' % (n_tabs + 1, line.count('\t') + 1))
+            elements = line.split('\t')
+            try:
+                yield tuple([f(elements[i]) for (f, i) in zip(convert, indices)])
+            except ValueError as err:
+                raise TabFormatError(path, line_no, str(err))
+    finally:
+        infile.close()
+
+
+def read_columns(path, names, types=None):
+    """Read columns into a dictionary of lists, keyed by column name."""
+    columns = dict([(name, []) for name in names])
+    for row in iter_rows(path, names, types):
+        for (name, value) in zip(names, row):
+            columns[name].append(value)
+    return columns
+
+
+def read_index(path, key_name, val_name, types=None):
+    """Read two columns into a dictionary lkp[key] = value; later rows win."""
+    return dict(iter_rows(path, (key_name, val_name), types))
+
+
+def read_keys(path, key_name, key_type=int):
+    """Read the distinct values of one column into a set."""
+    return set([x[0] for x in iter_rows(path, (key_name,), {key_name: key_type})])
@@ -0,0 +1,146 @@
+"""Script:  target_summary.py
+
+Materialized per-target activity counts for coverage.get_el_targets and
+coverage.get_el_target_buckets. The table target_activity_summary holds, for
+each eligible target (tid, target_type, domain_count) and standard_value (in
+nM), the number of activities with that value and the number of assays whose
+lowest value it is. The counts up to any threshold are then sums over the
+rows with standard_value <= threshold, and bucketed counts sums grouped by a
+CASE over the limits.
+
+The table is built once per release; target_activity_summary_info records
+the release it was built for, and it is rebuilt when the release changes.
+Select it with target_summary: True in local.yaml, or build it ahead of
+time:
+    $> python target_summary.py
+    $> python target_summary.py rebuild
+
+--------------------
+Author:
+Felix Kruger
+fkrueger@ebi.ac.uk
+"""
+import sys
+import time
+import yaml
+import pg2_wrapper
+
+
+TABLE = 'target_activity_summary'
+
+SUMMARY_QUERY = """
+            WITH el AS (
+                  SELECT dc.tid, dc.target_type, dc.dc AS domain_count, act.assay_id, act.activity_id, act.standard_value
+                  FROM assays ass
+                  JOIN(
+                            SELECT td.tid, td.target_type, COUNT(cd.domain_id) as dc
+                            FROM target_dictionary td
+                            JOIN target_components tc
+                              ON tc.tid = td.tid
+                            JOIN component_sequences cs
+                              ON cs.component_id = tc.component_id
+                            JOIN component_domains cd
+                              ON cd.component_id = cs.component_id
+                            WHERE td.target_type IN('SINGLE PROTEIN', 'PROTEIN COMPLEX')
+                            GROUP BY td.tid
+                           ) as dc
+                    ON dc.tid = ass.tid
+                  JOIN activities act
+                    ON act.assay_id = ass.assay_id
+                  WHERE act.standard_type IN('Ki','Kd','IC50','EC50', 'AC50')
+                  AND ass.relationship_type = 'D'
+                  AND assay_type IN('B')
+                  AND act.standard_relation IN('=')
+                  AND standard_units = 'nM'
+                  AND standard_value IS NOT NULL
+                 ),
+            first AS (
+                  SELECT assay_id, MIN(standard_value) AS first_value
+                  FROM el
+                  GROUP BY assay_id
+                 )
+            SELECT el.tid, el.target_type, el.domain_count, el.standard_value,
+                   COUNT(DISTINCT CASE WHEN el.standard_value = first.first_value THEN el.assay_id END) AS assay_count,
+                   COUNT(DISTINCT el.activity_id) AS act_count
+            FROM el
+            JOIN first
+              ON first.assay_id = el.assay_id
+            GROUP BY el.tid, el.target_type, el.domain_count, el.standard_value"""
+
+
+def to_limit(threshold):
+    """Limit in nM of a threshold in uM."""
+    return round(threshold * 1000, 6)
+
+
+def read_info(params):
+    """Return the release the summary was built for, or None."""
+    if pg2_wrapper.is_sqlite(params):
+        exists = len(pg2_wrapper.sql_query("""SELECT name FROM sqlite_master WHERE type = 'table' AND name = %s""", ['%s_info' % TABLE], params)) > 0
+    else:
+        exists = pg2_wrapper.sql_query("""SELECT to_regclass(%s)""", ['%s_info' % TABLE], params)[0][0] is not None
+    if not exists:
+        return None
+    rows = pg2_wrapper.sql_query("""SELECT release FROM %s_info""" % TABLE, [], params)
+    if not rows:
+        return None
+    return rows[0][0]
+
+
+def build(params):
+    """Build the summary into a staging table and swap it in, together with
+    its info row, in one transaction. Returns the number of rows."""
+    new = '%s_new' % TABLE
+    pg2_wrapper.sql_execute("""DROP TABLE IF EXISTS %s""" % new, [], params)
+    pg2_wrapper.sql_execute("""CREATE TABLE %s AS %s""" % (new, SUMMARY_QUERY), [], params)
+    pg2_wrapper.sql_transaction(["""DROP TABLE IF EXISTS %s""" % TABLE,
+                                 """ALTER TABLE %s RENAME TO %s""" % (new, TABLE),
+                                 """CREATE INDEX %s_value ON %s (standard_value)""" % (TABLE, TABLE),
+                                 """DROP TABLE IF EXISTS %s_info""" % TABLE,
+                                 """CREATE TABLE %s_info (release VARCHAR(50) NOT NULL, built VARCHAR(25) NOT NULL)""" % TABLE,
+                                 """INSERT INTO %s_info VALUES ('%s', '%s')""" % (TABLE, params['release'], time.strftime('%Y-%m-%d %H:%M:%S')),
+                                 """ANALYZE %s""" % TABLE], params)
+    return pg2_wrapper.sql_query("""SELECT COUNT(*) FROM %s""" % TABLE, [], params)[0][0]
+
+
+def refresh(params, force=False):
+    """Build the summary if it is missing or was built for another release."""
+    if not force and read_info(params) == params['release']:
+        return
+    start = time.time()
+    n = build(params)
+    print "built %s for %s: %i rows in %.1f s" % (TABLE, params['release'], n, time.time() - start)
+
+
+def get_el_targets(limit, params):
+    """Eligible targets from the summary, as coverage.get_el_targets:
+    [(tid, target_type, domain_count, assay_count, act_count),...] of the
+    activities with standard_value <= limit (in nM)."""
+    refresh(params)
+    return pg2_wrapper.sql_query("""
+            SELECT tid, target_type, domain_count, CAST(SUM(assay_count) AS BIGINT), CAST(SUM(act_count) AS BIGINT)
+            FROM %s
+            WHERE standard_value <= %%s
+            GROUP BY tid, target_type, domain_count ORDER BY SUM(act_count)""" % TABLE, [limit], params)
+
+
+def get_el_target_buckets(limits, params):
+    """Bucketed activity counts from the summary, as
+    coverage.get_el_target_buckets, for ascending limits (in nM)."""
+    refresh(params)
+    case = ' '.join(['WHEN standard_value <= %%s THEN %i' % i for i in range(len(limits))])
+    return pg2_wrapper.sql_query("""
+            SELECT tid, target_type, domain_count, CASE %s END AS b, CAST(SUM(act_count) AS BIGINT)
+            FROM %s
+            WHERE standard_value <= %%s
+            GROUP BY tid, target_type, domain_count, b""" % (case, TABLE), list(limits) + [limits[-1]], params)
+
+
+if __name__ == '__main__':
+    param_file = open('local.yaml')
+    params = yaml.safe_load(param_file)
+    param_file.close()
+    if len(sys.argv) > 2 or (len(sys.argv) == 2 and sys.argv[1] != 'rebuild'):
+        sys.exit("Usage: python target_summary.py [rebuild]")
+    refresh(params, force=len(sys.argv) == 2)
+    pg2_wrapper.close_pools()
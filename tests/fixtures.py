@@ -0,0 +1,84 @@
+"""Shared fixtures of the tests: a temporary working directory per test and
+random tables in the formats the pipeline reads and writes. Importing this
+module puts the repository root on sys.path.
+"""
+import datetime
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from rowwriter import MAPS_HEADER, MAPS_LINE
+
+
+PARAMS = {'comment': 'test 100% comment', 'timestamp': '06 Aug 2013 14:04:55', 'submitter': 'system', 'write_batch': 7}
+
+
+class WorkdirTest(unittest.TestCase):
+    """Test case with a temporary directory self.workdir, removed afterwards."""
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+
+def get_acts_rows(n, seed):
+    """get_acts rows with single and conflicting activities, repeated pairs
+    and pairs whose domain changes between rows."""
+    rng = random.Random(seed)
+    rows = []
+    for i in range(n):
+        act_id = rng.randint(1, n // 3 + 1) * 17
+        compd_id = rng.choice([rng.randint(1, 40), rng.randint(1, 10 ** 6)])
+        domain_id = rng.randint(1, 12)
+        rows.append((act_id, 1, 1, compd_id, 'dom_%i' % domain_id, domain_id))
+    return rows
+
+
+def manual_rows(n, seed):
+    """Rows of the pfam_maps query of exporter.retrieve_acts, with timestamps
+    as strings and as datetimes."""
+    rng = random.Random(seed)
+    acts = []
+    for i in range(n):
+        if i % 2:
+            timestamp = datetime.datetime(2013, 8, rng.randint(1, 28), rng.randint(0, 23), rng.randint(0, 59), rng.randint(0, 59))
+        else:
+            timestamp = '2013-08-%02i 12:49:27' % rng.randint(1, 28)
+        acts.append((i, rng.randint(1, 10 ** 7), rng.randint(1, 10 ** 6), 'dom_%i' % rng.randint(1, 50), rng.randint(0, 2),
+                     rng.randint(0, 1), 1, 'curated %i%% sure' % rng.randint(0, 100), timestamp, 'fak', rng.randint(1, 3000)))
+    return acts
+
+
+def manual_versions(n, seed):
+    """Three versions of a manual mapping file out of key order. The second
+    inserts, deletes and changes rows and has a blank line, the third lacks
+    the final newline."""
+    rng = random.Random(seed)
+    rows = {}
+    for i in range(n):
+        rows[(rng.randint(1, 10 ** 6), rng.randint(1, 10 ** 6))] = (rng.randint(0, 2), 'first round')
+    versions = []
+    for v in range(3):
+        keys = rows.keys()
+        rng.shuffle(keys)
+        lines = [MAPS_LINE % (act_id, compd_id, 'Pkinase', 0, rows[(act_id, compd_id)][0], 1,
+                              rows[(act_id, compd_id)][1], '2013-08-12 12:49:27', 'fak', 2640)
+                 for (act_id, compd_id) in keys]
+        if v == 1:
+            lines.insert(n // 2, '\n')
+        if v == 2:
+            lines[-1] = lines[-1].rstrip('\n')
+        versions.append(MAPS_HEADER + ''.join(lines))
+        for key in keys[:n // 10]:
+            del rows[key]
+        for key in keys[n // 10:n // 5]:
+            rows[key] = (rows[key][0], 'round %i' % (v + 2))
+        for i in range(n // 10):
+            rows[(rng.randint(1, 10 ** 6), rng.randint(1, 10 ** 6))] = (1, 'added')
+    return versions
@@ -0,0 +1,44 @@
+"""Tests for array_maps.py: the numpy engine writes the same table as the
+dict engine of loader.py.
+
+Run from the repository root:
+    $> python -m unittest discover tests
+"""
+import os
+import unittest
+
+from fixtures import PARAMS, WorkdirTest, get_acts_rows
+import array_maps
+import loader
+
+
+class EngineTest(WorkdirTest):
+
+    def write_both(self, rows, manuals):
+        dict_path = os.path.join(self.workdir, 'dict.tab')
+        lkp = loader.map_ints(rows)
+        loader.write_table(lkp, loader.flag_conflicts(lkp), manuals, PARAMS, dict_path)
+        numpy_path = os.path.join(self.workdir, 'numpy.tab')
+        maps = array_maps.map_ints(rows)
+        loader.write_rows(array_maps.format_rows(maps, array_maps.flag_conflicts(maps), manuals, PARAMS), numpy_path, PARAMS)
+        with open(dict_path, 'rb') as infile:
+            expected = infile.read()
+        with open(numpy_path, 'rb') as infile:
+            found = infile.read()
+        return (expected, found)
+
+    def test_identical_files(self):
+        for seed in range(5):
+            rows = get_acts_rows(2000, seed)
+            manuals = set([row[0] for row in rows[:50]])
+            (expected, found) = self.write_both(rows, manuals)
+            self.assertTrue(expected.count('\n') > 1000)
+            self.assertEqual(expected, found)
+
+    def test_empty(self):
+        (expected, found) = self.write_both([], set())
+        self.assertEqual(expected, found)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+"""Tests for pg2_wrapper.py: pooled PostgreSQL connections are reused.
+
+Needs a PostgreSQL database; set PG_TEST_PARAMS to a yaml file holding
+user, pword, host, port and release (the database name) as in local.yaml.
+Run from the repository root:
+    $> PG_TEST_PARAMS=pg.yaml python -m unittest discover tests
+"""
+import os
+import sys
+import threading
+import time
+import unittest
+import yaml
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import pg2_wrapper
+
+
+def read_params():
+    with open(os.environ['PG_TEST_PARAMS']) as param_file:
+        return yaml.safe_load(param_file)
+
+
+@unittest.skipUnless(os.environ.get('PG_TEST_PARAMS'), 'PG_TEST_PARAMS is not set')
+class PoolTest(unittest.TestCase):
+
+    def setUp(self):
+        pg2_wrapper.close_pools()
+        pg2_wrapper.reset_stats()
+        self.params = dict(read_params(), pool_size=2)
+
+    def tearDown(self):
+        pg2_wrapper.close_pools()
+
+    def test_reused(self):
+        for i in range(3):
+            self.assertEqual(pg2_wrapper.sql_query("""SELECT %s""", [i], self.params), [(i,)])
+        self.assertEqual(pg2_wrapper.stats['opened'], 1)
+        self.assertEqual(pg2_wrapper.stats['reused'], 2)
+
+    def test_pool_size(self):
+        # Nested connections open a second one; both are kept for reuse.
+        with pg2_wrapper.connection(self.params):
+            with pg2_wrapper.connection(self.params):
+                pass
+        for i in range(4):
+            pg2_wrapper.sql_query("""SELECT 1""", [], self.params)
+        self.assertEqual(pg2_wrapper.stats['opened'], 2)
+        self.assertEqual(pg2_wrapper.stats['reused'], 4)
+
+    def test_wait(self):
+        # More threads than pool_size wait for a connection instead of failing.
+        errors = []
+        def query():
+            try:
+                pg2_wrapper.sql_query("""SELECT pg_sleep(0.2)""", [], self.params)
+            except Exception as err:
+                errors.append(err)
+        threads = [threading.Thread(target=query) for i in range(5)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(pg2_wrapper.stats['opened'], 2)
+        self.assertTrue(time.time() - start >= 0.6)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+"""Tests for rowwriter.py: the mapping tables are the lines of the per-row
+locals() formatting they replace, and compressed tables read back through
+tabfile.
+
+Run from the repository root:
+    $> python -m unittest discover tests
+"""
+import os
+import unittest
+
+from fixtures import PARAMS, WorkdirTest, get_acts_rows, manual_rows
+import exporter
+import loader
+import rowwriter
+import tabfile
+
+
+def locals_table(acts):
+    """The manual mapping table as written by exporter.write_table before rowwriter."""
+    lines = ["""activity_id\tcompd_id\tdomain_name\tcategory_flag\tstatus_flag\tmanual_flag\tcomment\ttimestamp\tsubmitter\tdomain_id\n"""]
+    for act in acts:
+        act_id = act[1]
+        compd_id = act[2]
+        domain_name = act[3]
+        category_flag = act[4]
+        status_flag = act[5]
+        manual_flag = act[6]
+        comment = act[7]
+        timestamp = act[8]
+        submitter = act[9]
+        domain_id = act[10]
+        lines.append("""%(act_id)i\t%(compd_id)i\t%(domain_name)s\t%(category_flag)i\t%(status_flag)i\t%(manual_flag)i\t%(comment)s\t%(timestamp)s\t%(submitter)s\t%(domain_id)s\n"""%locals())
+    return ''.join(lines)
+
+
+def locals_rows(lkp, flag_lkp, manuals, params):
+    """The lines of loader.format_rows before rowwriter."""
+    comment = params['comment']
+    timestamp = params['timestamp']
+    submitter = params['submitter']
+    for act_id in set(map(int, lkp.keys())) - manuals:
+        compd_ids = lkp[act_id]
+        (category_flag, status_flag, manual_flag) = flag_lkp[act_id]
+        for compd_id in compd_ids.keys():
+            (domain_id, domain_name) = lkp[act_id][compd_id]
+            yield """%(act_id)i\t%(compd_id)i\t%(domain_name)s\t%(category_flag)i\t%(status_flag)i\t%(manual_flag)i\t%(comment)s\t%(timestamp)s\t%(submitter)s\t%(domain_id)s\n"""%locals()
+
+
+class WriterTest(WorkdirTest):
+
+    def read(self, path):
+        infile = tabfile.open_tab(path)
+        try:
+            return ''.join(infile)
+        finally:
+            infile.close()
+
+    def test_export_table(self):
+        acts = manual_rows(1000, 0)
+        path = os.path.join(self.workdir, 'manual.tab')
+        exporter.write_table(iter(acts), path, PARAMS)
+        self.assertEqual(self.read(path), locals_table(acts))
+
+    def test_automatic_rows(self):
+        rows = get_acts_rows(1000, 1)
+        lkp = loader.map_ints(rows)
+        flag_lkp = loader.flag_conflicts(lkp)
+        manuals = set([row[0] for row in rows[:20]])
+        self.assertEqual(list(loader.format_rows(lkp, flag_lkp, manuals, PARAMS)), list(locals_rows(lkp, flag_lkp, manuals, PARAMS)))
+
+    def test_compressed(self):
+        acts = manual_rows(3000, 2)
+        expected = locals_table(acts)
+        suffixes = ['.gz']
+        if rowwriter.zstandard is not None:
+            suffixes.append('.zst')
+        for suffix in suffixes:
+            for threads in (1, 3):
+                path = os.path.join(self.workdir, 'manual_%s_%i.tab%s' % (suffix[1:], threads, suffix))
+                params = dict(PARAMS, compress_threads=threads)
+                exporter.write_table(iter(acts), path, params)
+                self.assertEqual(self.read(path), expected)
+                # Resolved from the uncompressed name, as merge_rows does.
+                self.assertEqual(self.read(path[:-len(suffix)]), expected)
+
+    def test_resolve_newest(self):
+        path = os.path.join(self.workdir, 'manual.tab')
+        exporter.write_table(iter(manual_rows(10, 3)), path, PARAMS)
+        os.utime(path, (1000000000, 1000000000))
+        acts = manual_rows(10, 4)
+        exporter.write_table(iter(acts), path + '.gz', PARAMS)
+        # A stale plain file does not shadow the newer compressed one.
+        self.assertEqual(tabfile.resolve(path), path + '.gz')
+        self.assertEqual(self.read(path), locals_table(acts))
+
+    def test_threaded_gzip_members(self):
+        data = ''.join(['%i\tline\n' % i for i in range(50000)])
+        path = os.path.join(self.workdir, 'members.tab.gz')
+        out = rowwriter.GzipWriter(path, 3, block_size=1 << 14)
+        out.write(data)
+        out.close()
+        self.assertEqual(self.read(path), data)
+
+
+if __name__ == '__main__':
+    unittest.main()
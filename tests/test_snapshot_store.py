@@ -0,0 +1,65 @@
+"""Tests for snapshot_store.py: versions read back from the store are the
+bytes of the files they were added from.
+
+Run from the repository root:
+    $> python -m unittest discover tests
+"""
+import gzip
+import os
+import unittest
+
+from fixtures import WorkdirTest, manual_versions
+import snapshot_store
+
+
+class StoreTest(WorkdirTest):
+
+    def add(self, version, data):
+        path = os.path.join(self.workdir, 'manual_pfam_maps_v_%s.tab' % version)
+        with open(path, 'wb') as out:
+            out.write(data)
+        snapshot_store.add(path)
+        return path
+
+    def read(self, path):
+        return ''.join(snapshot_store.open_path(path))
+
+    def test_round_trip(self):
+        versions = manual_versions(500, 0)
+        paths = [self.add('1_%i' % i, data) for (i, data) in enumerate(versions)]
+        store_dir = os.path.join(self.workdir, 'store', 'manual_pfam_maps')
+        self.assertEqual(sorted([x for x in os.listdir(store_dir) if x.endswith('.tab.gz')]),
+                         ['base_v_1_0.tab.gz', 'delta_v_1_1.tab.gz', 'delta_v_1_2.tab.gz'])
+        for (path, data) in zip(paths, versions):
+            os.remove(path)
+            self.assertEqual(self.read(path), data)
+
+    def test_replace_latest(self):
+        versions = manual_versions(200, 1)
+        self.add('1_0', versions[0])
+        path = self.add('1_1', versions[1])
+        # Other columns turn the delta into a base snapshot.
+        data = versions[2].replace('\tdomain_id\n', '\tdomain_key\n', 1)
+        self.add('1_1', data)
+        store_dir = os.path.join(self.workdir, 'store', 'manual_pfam_maps')
+        self.assertFalse(os.path.exists(os.path.join(store_dir, 'delta_v_1_1.tab.gz')))
+        self.assertEqual([x for x in os.listdir(store_dir) if x.endswith('.tmp')], [])
+        self.assertEqual(self.read(path), data)
+        self.assertEqual(self.read(os.path.join(self.workdir, 'manual_pfam_maps_v_1_0.tab')), versions[0])
+
+    def test_add_compressed(self):
+        versions = manual_versions(200, 2)
+        self.add('1_0', versions[0])
+        path = os.path.join(self.workdir, 'manual_pfam_maps_v_1_1.tab')
+        with gzip.open(path + '.gz', 'wb') as out:
+            out.write(versions[1])
+        infile = gzip.open(path + '.gz', 'rb')
+        try:
+            snapshot_store.add(path, infile)
+        finally:
+            infile.close()
+        self.assertEqual(self.read(path), versions[1])
+
+
+if __name__ == '__main__':
+    unittest.main()